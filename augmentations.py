@@ -1,46 +1,178 @@
 
 import torch
 from typing import Tuple, Union
+import torch.nn.functional as F
 import torchvision.transforms as T
 
 
 class DeviceAgnosticColorJitter(T.ColorJitter):
     def __init__(self, brightness: float = 0., contrast: float = 0., saturation: float = 0., hue: float = 0.):
-        """This is the same as T.ColorJitter but it only accepts batches of images and works on GPU"""
+        """This is the same as T.ColorJitter but it only accepts batches of images and works on GPU.
+        The random factors (and the random order of the four transformations) are sampled for each
+        image as tensors, and each transformation is applied with broadcasted operations on all the
+        images which need it at that step, so the number of kernel launches doesn't depend on the batch size.
+        """
         super().__init__(brightness=brightness, contrast=contrast, saturation=saturation, hue=hue)
     
     def forward(self, images: torch.Tensor) -> torch.Tensor:
         assert len(images.shape) == 4, f"images should be a batch of images, but it has shape {images.shape}"
         B, C, H, W = images.shape
-        # Applies a different color jitter to each image
-        color_jitter = super(DeviceAgnosticColorJitter, self).forward
-        augmented_images = [color_jitter(img).unsqueeze(0) for img in images]
-        augmented_images = torch.cat(augmented_images)
+        # Applies a different color jitter to each image. Parameters are sampled on CPU, so that
+        # selecting the images for each transformation doesn't require a device synchronization
+        transforms = [(adjust_brightness, self.brightness), (adjust_contrast, self.contrast),
+                      (adjust_saturation, self.saturation), (adjust_hue, self.hue)]
+        factors = [None if bounds is None else torch.empty(B).uniform_(bounds[0], bounds[1])
+                   for _, bounds in transforms]
+        orders = torch.rand(B, len(transforms)).argsort(dim=1)  # A random permutation of the transformations for each image
+        augmented_images = images.clone()
+        for step in range(len(transforms)):
+            for transform_num, ((transform, _), transform_factors) in enumerate(zip(transforms, factors)):
+                if transform_factors is None:
+                    continue
+                selected = (orders[:, step] == transform_num).nonzero().squeeze(1)
+                if len(selected) == 0:
+                    continue
+                selected_factors = transform_factors[selected].to(images.device, non_blocking=True).view(-1, 1, 1, 1)
+                selected = selected.to(images.device, non_blocking=True)
+                augmented_images.index_copy_(0, selected, transform(augmented_images[selected], selected_factors))
         assert augmented_images.shape == torch.Size([B, C, H, W])
         return augmented_images
 
 
 class DeviceAgnosticRandomResizedCrop(T.RandomResizedCrop):
     def __init__(self, size: Union[int, Tuple[int, int]], scale: float):  
-        """This is the same as T.RandomResizedCrop but it only accepts batches of images and works on GPU"""
+        """This is the same as T.RandomResizedCrop but it only accepts batches of images and works on GPU.
+        Crops are sampled for all images at once, and cropping and resizing are done with a single
+        batched grid_sample (bilinear, without antialiasing).
+        """
         super().__init__(size=size, scale=scale)
 
     # Viene ereditata da una trasformazione chiamata RandomResizedCrop in cui size è la dimensione dell'immagine di output
     # e scale è il range da cui verrà preso il valore random di zoom che sarà moltiplicato per l'immagine prima di
     # farne il resize
     
-    def forward(self, images: torch.Tensor) -> torch.Tensor:            # all'interno di qeusto forward c'è quello alla classe parent
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
         assert len(images.shape) == 4, f"images should be a batch of images, but it has shape {images.shape}"
         B, C, H, W = images.shape
         # Applies a different ResizedCrop to each image
-        random_resized_crop = super(DeviceAgnosticRandomResizedCrop, self).forward      # prende la trasformazione della classe parent
-        augmented_images = [random_resized_crop(img).unsqueeze(0) for img in images]    # la applica ad ogni immagine (è una lista)
-        augmented_images = torch.cat(augmented_images)                                  # da lista a tensore in 4 dimensioni
+        crops_i, crops_j, crops_h, crops_w = self.get_batch_params(B, H, W, self.scale, self.ratio)
+        # Affine transformation from the output grid to the crop, in normalized coordinates (align_corners=False)
+        theta = torch.zeros(B, 2, 3)
+        theta[:, 0, 0] = crops_w / W
+        theta[:, 0, 2] = (2 * crops_j + crops_w) / W - 1
+        theta[:, 1, 1] = crops_h / H
+        theta[:, 1, 2] = (2 * crops_i + crops_h) / H - 1
+        theta = theta.to(device=images.device, dtype=images.dtype, non_blocking=True)
+        grid = F.affine_grid(theta, [B, C, *self.size], align_corners=False)
+        augmented_images = F.grid_sample(images, grid, mode="bilinear", padding_mode="border", align_corners=False)
         return augmented_images
+    
+    @staticmethod
+    def get_batch_params(batch_size: int, height: int, width: int, scale: Tuple[float, float],
+                         ratio: Tuple[float, float], attempts: int = 10) -> Tuple[torch.Tensor, ...]:
+        """Vectorized version of T.RandomResizedCrop.get_params(), which returns the top, left,
+        height and width of a random crop for each image of the batch, as float tensors.
+        """
+        area = height * width
+        log_ratio = torch.log(torch.tensor(ratio))
+        target_area = area * torch.empty(batch_size, attempts).uniform_(scale[0], scale[1])
+        aspect_ratio = torch.exp(torch.empty(batch_size, attempts).uniform_(log_ratio[0], log_ratio[1]))
+        w = torch.sqrt(target_area * aspect_ratio).round()
+        h = torch.sqrt(target_area / aspect_ratio).round()
+        is_valid = (0 < w) & (w <= width) & (0 < h) & (h <= height)
+        
+        # Fallback to central crop, used for the images without any valid attempt
+        in_ratio = width / height
+        if in_ratio < min(ratio):
+            fallback_w, fallback_h = width, round(width / min(ratio))
+        elif in_ratio > max(ratio):
+            fallback_w, fallback_h = round(height * max(ratio)), height
+        else:  # whole image
+            fallback_w, fallback_h = width, height
+        
+        has_valid = is_valid.any(dim=1)
+        first_valid = is_valid.float().argmax(dim=1)
+        batch_indices = torch.arange(batch_size)
+        crops_w = torch.where(has_valid, w[batch_indices, first_valid], torch.tensor(float(fallback_w)))
+        crops_h = torch.where(has_valid, h[batch_indices, first_valid], torch.tensor(float(fallback_h)))
+        random_i = (torch.rand(batch_size) * (height - crops_h + 1)).floor()
+        random_j = (torch.rand(batch_size) * (width - crops_w + 1)).floor()
+        crops_i = torch.where(has_valid, random_i, ((height - crops_h) // 2))
+        crops_j = torch.where(has_valid, random_j, ((width - crops_w) // 2))
+        return crops_i, crops_j, crops_h, crops_w
 
     # Applicarla a tutte le immagini del dataset o durante il training piuttosto che farlo in questo modo cosa ha di diverso?
     # Ti evita di iterare sulle immagini durante il training in modo più esplicito?
 
+
+def rgb_to_grayscale(images: torch.Tensor) -> torch.Tensor:
+    r, g, b = images.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+
+def blend(images1: torch.Tensor, images2: torch.Tensor, ratios: torch.Tensor) -> torch.Tensor:
+    return (ratios * images1 + (1.0 - ratios) * images2).clamp(0, 1)
+
+
+def adjust_brightness(images: torch.Tensor, factors: torch.Tensor) -> torch.Tensor:
+    """Same as T.functional.adjust_brightness, with a different factor for each image ([B, 1, 1, 1])."""
+    return blend(images, torch.zeros_like(images), factors)
+
+
+def adjust_contrast(images: torch.Tensor, factors: torch.Tensor) -> torch.Tensor:
+    """Same as T.functional.adjust_contrast, with a different factor for each image ([B, 1, 1, 1])."""
+    mean = torch.mean(rgb_to_grayscale(images), dim=(-3, -2, -1), keepdim=True)
+    return blend(images, mean, factors)
+
+
+def adjust_saturation(images: torch.Tensor, factors: torch.Tensor) -> torch.Tensor:
+    """Same as T.functional.adjust_saturation, with a different factor for each image ([B, 1, 1, 1])."""
+    return blend(images, rgb_to_grayscale(images), factors)
+
+
+def adjust_hue(images: torch.Tensor, factors: torch.Tensor) -> torch.Tensor:
+    """Same as T.functional.adjust_hue, with a different factor for each image ([B, 1, 1, 1])."""
+    h, s, v = rgb_to_hsv(images).unbind(dim=-3)
+    h = (h + factors.view(-1, 1, 1)) % 1.0
+    return hsv_to_rgb(torch.stack((h, s, v), dim=-3))
+
+
+def rgb_to_hsv(images: torch.Tensor) -> torch.Tensor:
+    # Same implementation as torchvision's (private) _rgb2hsv, which works on batches
+    r, g, b = images.unbind(dim=-3)
+    maxc = torch.max(images, dim=-3).values
+    minc = torch.min(images, dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def hsv_to_rgb(images: torch.Tensor) -> torch.Tensor:
+    # Same implementation as torchvision's (private) _hsv2rgb, which works on batches
+    h, s, v = images.unbind(dim=-3)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int32) % 6
+    p = torch.clamp((v * (1.0 - s)), 0.0, 1.0)
+    q = torch.clamp((v * (1.0 - s * f)), 0.0, 1.0)
+    t = torch.clamp((v * (1.0 - s * (1.0 - f))), 0.0, 1.0)
+    mask = i.unsqueeze(dim=-3) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    a4 = torch.stack((a1, a2, a3), dim=-4)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask.to(dtype=images.dtype), a4)
+
 if __name__ == "__main__":
     """
     You can run this script to visualize the transformations, and verify that
@@ -0,0 +1,29 @@
+
+import sys
+import logging
+from datetime import datetime
+
+import parser
+import commons
+from datasets.image_shards import ImageShards
+from datasets.train_dataset import TrainDataset
+
+# Decodes the training set into the uint8 shards used by train.py with --train_shards_folder, e.g.
+# python build_shards.py --dataset_folder /path/to/sf_xl/processed --train_shards_folder /path/to/shards
+
+args = parser.parse_arguments()
+start_time = datetime.now()
+output_folder = f"logs/{args.save_dir}/{start_time.strftime('%Y-%m-%d_%H-%M-%S')}"
+commons.setup_logging(output_folder, console="info")
+logging.info(" ".join(sys.argv))
+logging.info(f"Arguments: {args}")
+
+if args.train_shards_folder is None:
+    raise ValueError("You should set parameter --train_shards_folder to the folder where to save the shards")
+
+train_cache = TrainDataset.load_cache(args, args.train_set_folder, M=args.M, alpha=args.alpha, N=args.N, L=args.L,
+                                      min_images_per_class=args.min_images_per_class)
+ImageShards.build(train_cache, args.train_shards_folder, images_per_shard=args.images_per_shard,
+                  processes=max(1, args.num_workers))
+
+logging.info(f"Shards saved in {args.train_shards_folder} in {str(datetime.now() - start_time)[:-7]}")
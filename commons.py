@@ -1,30 +1,268 @@
 
 import os
 import sys
+import queue
 import torch
 import random
 import logging
 import traceback
 import numpy as np
+import torch.multiprocessing as mp
 
 
-class InfiniteDataLoader(torch.utils.data.DataLoader):      # classe che eredita dal dataloader. Non mi è chiaro per cosa la usano
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.dataset_iterator = super().__iter__()          # questo è l'iteratore. Fa fatto per forza perché è ereditata?
+class GroupsDataset(torch.utils.data.Dataset):
+    def __init__(self, groups: list):
+        """Dataset over all the groups, indexed by (group_num, index within the group)."""
+        self.groups = groups
     
-    def __iter__(self):                                     # necessario riscriverlo se si eredita da questa classe?
+    def __getitem__(self, index):
+        group_num, group_index = index
+        return self.groups[group_num][group_index]
+    
+    def __len__(self):
+        return sum(len(g) for g in self.groups)
+
+
+class GroupBatchSampler(torch.utils.data.Sampler):
+    def __init__(self, groups_lens: list, batch_size: int):
+        """Infinite sampler of shuffled batches (dropping the last incomplete one of each pass) of
+        (group_num, index) indices, all from the current group, which can be changed at any time."""
+        self.groups_lens = groups_lens
+        self.batch_size = batch_size
+        self.group_num = 0
+        self.batches_num = 0  # Number of batches yielded so far
+    
+    def __iter__(self):
+        while True:
+            group_num = self.group_num
+            permutation = torch.randperm(self.groups_lens[group_num]).tolist()
+            for start in range(0, len(permutation) - self.batch_size + 1, self.batch_size):
+                if self.group_num != group_num:
+                    break
+                self.batches_num += 1
+                yield [(group_num, i) for i in permutation[start : start + self.batch_size]]
+
+
+class GroupsDataLoader:
+    def __init__(self, groups: list, batch_size: int, num_workers: int, pin_memory: bool = False, group_num: int = 0):
+        """Infinite loader of shuffled batches from one group at a time (like a DataLoader over each group
+        with shuffle=True and drop_last=True, restarted at each pass), whose workers are started only once and are
+        shared by all groups. After set_group(), workers start loading batches of the new group in the
+        background, so that calling it before validation hides the loading of the first batches.
+        """
+        self.sampler = GroupBatchSampler([len(g) for g in groups], batch_size)
+        self.sampler.group_num = group_num
+        self.dataloader = torch.utils.data.DataLoader(GroupsDataset(groups), batch_sampler=self.sampler,
+                                                      num_workers=num_workers, pin_memory=pin_memory)
+        self.dataloader_iterator = None
+        self.batches_num = 0  # Number of batches returned so far
+    
+    def set_group(self, group_num: int):
+        if group_num == self.sampler.group_num:
+            return
+        self.sampler.group_num = group_num
+        if self.dataloader_iterator is None:
+            return
+        # Batches already requested to the workers belong to the previous group: receive and discard
+        # them, so that the dataloader requests (and workers start loading) batches of the new group.
+        # Each batch received makes the dataloader request a new one, so only those requested so far are drained
+        pending_batches_num = self.sampler.batches_num
+        while self.batches_num < pending_batches_num:
+            next(self.dataloader_iterator)
+            self.batches_num += 1
+    
+    def __iter__(self):
         return self
     
-    def __next__(self):                                     # hanno solo riscritto questo metodo
+    def __next__(self):
+        if self.dataloader_iterator is None:
+            self.dataloader_iterator = iter(self.dataloader)  # The only iterator, the sampler is infinite
+        batch = next(self.dataloader_iterator)
+        self.batches_num += 1
+        return batch
+    
+    def close(self):
+        # Without persistent_workers the dataloader keeps no reference to its iterator (workers already
+        # persist, since the sampler is infinite), so deleting it shuts its workers down
+        self.dataloader_iterator = None
+
+
+class SharedMemoryBatchLoader:
+    def __init__(self, groups: list, batch_size: int, num_workers: int, device: str, group_num: int = 0,
+                 slots_num: int = None, image_shape: tuple = (3, 224, 224), worker_timeout: float = 5):
+        """Same as GroupsDataLoader, but workers write uint8 images directly within the slots of
+        a ring buffer in shared memory, instead of pickling float tensors through queues.
+        Images are converted to float on device.
+        Each group must implement get_uint8_item(index), returning a uint8 image and its target.
+        Batches are (images, targets, None), with images in [0, 1] and not normalized.
+        On CUDA the slots are also page-locked, so that they are copied to device asynchronously.
+        Every worker_timeout seconds without batches, workers are checked to be still alive.
+        """
+        self.groups = groups
+        self.batch_size = batch_size
+        self.device = device
+        self.worker_timeout = worker_timeout
+        num_workers = max(1, num_workers)
+        self.slots_num = slots_num or 2 * num_workers
+        self.images_slots = torch.empty([self.slots_num, batch_size, *image_shape], dtype=torch.uint8).share_memory_()
+        self.targets_slots = torch.empty([self.slots_num, batch_size], dtype=torch.int64).share_memory_()
+        self.batches_indices = [self.get_batches_indices(len(g)) for g in groups]
+        self.group_num = group_num
+        self.tasks_queue = mp.Queue()
+        self.done_queue = mp.Queue()
+        base_seed = int(torch.empty((), dtype=torch.int64).random_())
+        self.workers = [mp.Process(target=shared_memory_worker, daemon=True,
+                                   args=(groups, self.images_slots, self.targets_slots,
+                                         self.tasks_queue, self.done_queue, base_seed + worker_id))
+                        for worker_id in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        # Slots are pinned after starting the workers, so that CUDA is not initialized before forking
+        self.is_pinned = torch.device(device).type == "cuda"
+        if self.is_pinned:
+            for slots in [self.images_slots, self.targets_slots]:
+                torch.cuda.check_error(torch.cuda.cudart().cudaHostRegister(
+                    slots.data_ptr(), slots.numel() * slots.element_size(), 0))
+        # The slot whose asynchronous copy to device may still be running, and the event marking its end
+        self.copying_slot = None
+        self.copy_event = None
+        self.is_done = [False] * self.slots_num
+        for slot in range(self.slots_num):
+            self.put_task(slot)
+        self.next_slot = 0
+    
+    def get_batches_indices(self, dataset_len):
+        while True:
+            permutation = torch.randperm(dataset_len).tolist()
+            for start in range(0, len(permutation) - self.batch_size + 1, self.batch_size):
+                yield permutation[start : start + self.batch_size]
+    
+    def put_task(self, slot):
+        self.tasks_queue.put((slot, self.group_num, next(self.batches_indices[self.group_num])))
+    
+    def wait_slot(self, slot):
+        while not self.is_done[slot]:
+            try:
+                done_slot, error = self.done_queue.get(timeout=self.worker_timeout)
+            except queue.Empty:
+                dead_workers_num = sum(not worker.is_alive() for worker in self.workers)
+                if dead_workers_num > 0:
+                    self.close()
+                    raise RuntimeError(f"{dead_workers_num} workers of SharedMemoryBatchLoader exited unexpectedly")
+                continue
+            if error is not None:
+                self.close()
+                raise RuntimeError(f"A worker of SharedMemoryBatchLoader failed with:\n{error}")
+            self.is_done[done_slot] = True
+    
+    def release_copying_slot(self):
+        """Wait for the copy to device of the last returned slot, and return the slot."""
+        if self.copying_slot is None:
+            return None
+        if self.copy_event is not None:
+            self.copy_event.synchronize()
+        slot, self.copying_slot, self.copy_event = self.copying_slot, None, None
+        return slot
+    
+    def set_group(self, group_num: int):
+        if group_num == self.group_num:
+            return
+        self.group_num = group_num
+        # The slot being copied has no pending task, so it is already free
+        copied_slot = self.release_copying_slot()
+        if copied_slot is not None:
+            self.is_done[copied_slot] = True
+        # All slots contain (or are being filled with) batches of the previous group: wait for
+        # the workers to finish them, and fill them again with batches of the new group
+        for slot in range(self.slots_num):
+            self.wait_slot(slot)
+            self.is_done[slot] = False
+        self.next_slot = 0
+        for slot in range(self.slots_num):
+            self.put_task(slot)
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        # Batches are returned in the same order as they are requested, whichever worker finishes first
+        # The slot returned by the previous call is given back to the workers once it has been copied
+        copied_slot = self.release_copying_slot()
+        if copied_slot is not None:
+            self.put_task(copied_slot)
+        slot = self.next_slot
+        self.wait_slot(slot)
+        images = self.images_slots[slot].to(self.device, non_blocking=True, copy=True)
+        targets = self.targets_slots[slot].to(self.device, non_blocking=True, copy=True)
+        if self.is_pinned:
+            self.copy_event = torch.cuda.Event()
+            self.copy_event.record()
+        self.is_done[slot] = False
+        self.copying_slot = slot
+        self.next_slot = (slot + 1) % self.slots_num
+        return images.float().div_(255), targets, None
+    
+    def close(self):
+        for _ in self.workers:
+            self.tasks_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        if self.is_pinned:
+            self.release_copying_slot()
+            for slots in [self.images_slots, self.targets_slots]:
+                torch.cuda.cudart().cudaHostUnregister(slots.data_ptr())
+            self.is_pinned = False
+
+
+def shared_memory_worker(groups, images_slots, targets_slots, tasks_queue, done_queue, seed):
+    random.seed(seed)
+    np.random.seed(seed % 2**32)
+    torch.manual_seed(seed)
+    torch.set_num_threads(1)
+    while True:
+        task = tasks_queue.get()
+        if task is None:
+            break
+        slot, group_num, indices = task
         try:
-            batch = next(self.dataset_iterator)             # prova a ottenere il prossimo batch
-        except StopIteration:                               # se non riesce, stoppa l'iterazione attuale (?)
-            self.dataset_iterator = super().__iter__()      # Non l'aveva fatto su?
-            batch = next(self.dataset_iterator)             # altrimenti ottiene il prossimo batch
-        return batch                                        # e lo restituisce
+            for i, index in enumerate(indices):
+                image, target = groups[group_num].get_uint8_item(index)
+                images_slots[slot, i].copy_(image)
+                targets_slots[slot, i] = target
+            done_queue.put((slot, None))
+        except Exception:
+            done_queue.put((slot, traceback.format_exc()))
+
+
+class DeviceAccumulator:
+    def __init__(self, device: str, history_len: int = 0):
+        """Accumulate a scalar tensor (e.g. the loss) at each iteration, keeping the running sum on
+        device, so that adding a value doesn't wait for the device (unlike calling .item()).
+        If history_len > 0, each value is also saved within a preallocated buffer of that length.
+        """
+        self.sum = torch.zeros((), dtype=torch.float64, device=device)
+        self.count = 0
+        self.history = torch.empty(history_len, dtype=torch.float32, device=device) if history_len > 0 else None
+    
+    def add(self, value: torch.Tensor):
+        value = value.detach()
+        self.sum += value
+        if self.history is not None and self.count < len(self.history):
+            self.history[self.count] = value
+        self.count += 1
+    
+    def mean(self) -> float:
+        """Return the mean of the values added so far (this waits for the device)."""
+        return self.sum.item() / max(self.count, 1)
+    
+    def get_history(self) -> np.ndarray:
+        if self.history is None:
+            return np.zeros(0, dtype=np.float32)
+        return self.history[:self.count].cpu().numpy()
 
-    # penso che anche quella normale si sarebbe fermata senza più batch. Boh
 
 def make_deterministic(seed: int = 0):
     """Make results deterministic. If seed == -1, do not make deterministic.
@@ -0,0 +1,30 @@
+
+import os
+import shutil
+import numpy as np
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_folder(folder):
+    """Yield a temporary folder to write files in, which replaces folder once the block ends
+    without errors. Since it is renamed only when complete, an interrupted run never leaves a
+    partially written folder (e.g. a cache), which would otherwise be loaded by the next run.
+    """
+    tmp_folder = f"{folder}.{os.getpid()}.tmp"
+    os.makedirs(tmp_folder, exist_ok=True)
+    try:
+        yield tmp_folder
+    except BaseException:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        raise
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.rename(tmp_folder, folder)
+
+
+def save_arrays(folder, arrays):
+    """Save each array of the dict arrays as {name}.npy within folder, atomically."""
+    with atomic_folder(folder) as tmp_folder:
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_folder, f"{name}.npy"), array)
@@ -0,0 +1,140 @@
+
+import os
+import numpy as np
+from multiprocessing import Pool
+
+
+def scan_folder(folder):
+    """Return the mtime of folder, its subfolders and the paths of its .jpg images (not recursively).
+    Like glob, hidden files and folders are ignored, and paths are built with os.path.join.
+    """
+    mtime = os.stat(folder).st_mtime_ns
+    subfolders, images_paths = [], []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                subfolders.append(os.path.join(folder, entry.name))
+            elif entry.name.endswith(".jpg"):
+                images_paths.append(os.path.join(folder, entry.name))
+    return mtime, sorted(subfolders), images_paths
+
+
+class FolderManifest:
+    """Manifest of all the folders within a dataset folder, with the mtime of each folder, its
+    subfolders and the paths of the .jpg images it directly contains.
+    When a file or a subfolder is added to (or removed from) a folder, the mtime of the folder
+    changes, therefore update() only needs to stat each folder, and to list only those that changed.
+    """
+    ARRAYS_NAMES = ["folders_paths", "folders_offsets", "folders_mtimes", "folders_parents",
+                    "images_paths", "images_offsets", "folders_images_offsets"]
+
+    def __init__(self):
+        # Each folder is mapped to [mtime, subfolders, images_paths]. For folders loaded from disk,
+        # images_paths is a (start, end) range within self.images_arrays, decoded only when needed
+        self.folders = {}
+        self.images_arrays = None
+
+    @staticmethod
+    def load(folder, prefix="manifest_"):
+        manifest = FolderManifest()
+        arrays = {name: np.load(os.path.join(folder, f"{prefix}{name}.npy"), mmap_mode="r")
+                  for name in FolderManifest.ARRAYS_NAMES}
+        manifest.images_arrays = (arrays["images_paths"], arrays["images_offsets"])
+        folders_paths = decode_paths(arrays["folders_paths"], arrays["folders_offsets"])
+        for i, folder_path in enumerate(folders_paths):
+            images_range = (int(arrays["folders_images_offsets"][i]), int(arrays["folders_images_offsets"][i+1]))
+            manifest.folders[folder_path] = [int(arrays["folders_mtimes"][i]), [], images_range]
+        for folder_path, parent in zip(folders_paths, arrays["folders_parents"]):
+            if parent >= 0:
+                manifest.folders[folders_paths[parent]][1].append(folder_path)
+        return manifest
+
+    @staticmethod
+    def exists(folder, prefix="manifest_"):
+        return all(os.path.exists(os.path.join(folder, f"{prefix}{name}.npy")) for name in FolderManifest.ARRAYS_NAMES)
+
+    def get_arrays(self):
+        """Return the manifest as a dict of flat NumPy arrays, to be saved with np.save()."""
+        folders_paths = list(self.folders.keys())
+        folders_indices = {f: i for i, f in enumerate(folders_paths)}
+        folders_parents = np.full(len(folders_paths), -1, dtype=np.int64)
+        for folder_path, (_, subfolders, _) in self.folders.items():
+            folders_parents[[folders_indices[s] for s in subfolders]] = folders_indices[folder_path]
+        images_per_folder = [self.get_folder_images(f) for f in folders_paths]
+        images_paths, images_offsets = encode_paths([p for images in images_per_folder for p in images])
+        folders_paths_buffer, folders_offsets = encode_paths(folders_paths)
+        return {
+            "folders_paths": folders_paths_buffer,
+            "folders_offsets": folders_offsets,
+            "folders_mtimes": np.array([self.folders[f][0] for f in folders_paths], dtype=np.int64),
+            "folders_parents": folders_parents,
+            "images_paths": images_paths,
+            "images_offsets": images_offsets,
+            "folders_images_offsets": np.cumsum([0] + [len(i) for i in images_per_folder], dtype=np.int64),
+        }
+
+    def save(self, folder, prefix="manifest_"):
+        for name, array in self.get_arrays().items():
+            np.save(os.path.join(folder, f"{prefix}{name}.npy"), array)
+
+    def get_folder_images(self, folder_path):
+        images = self.folders[folder_path][2]
+        if isinstance(images, tuple):
+            start, end = images
+            images_paths, images_offsets = self.images_arrays
+            return decode_paths(images_paths, images_offsets[start : end+1] - images_offsets[start],
+                                buffer_start=images_offsets[start])
+        return images
+
+    def get_images_paths(self):
+        """Return the sorted paths of all images, i.e. the same as
+        sorted(glob(f"{root}/**/*.jpg", recursive=True))."""
+        return sorted(p for folder_path in self.folders for p in self.get_folder_images(folder_path))
+
+    def update(self, root, processes=1):
+        """Update the manifest with the current content of root, listing only the folders which
+        are new or whose mtime changed. Folders of the same depth are listed in parallel.
+        Return the list of folders which changed (all of them, when the manifest is empty).
+        """
+        old_folders = self.folders
+        self.folders = {}
+        changed_folders = []
+        level = [root]
+        pool = Pool(processes) if processes > 1 else None
+        try:
+            while len(level) > 0:
+                to_scan = []
+                for folder_path in level:
+                    old_entry = old_folders.get(folder_path)
+                    if old_entry is not None and old_entry[0] == os.stat(folder_path).st_mtime_ns:
+                        self.folders[folder_path] = old_entry
+                    else:
+                        to_scan.append(folder_path)
+                scanned = pool.map(scan_folder, to_scan, chunksize=1) if pool is not None and len(to_scan) > 1 \
+                    else map(scan_folder, to_scan)
+                for folder_path, (mtime, subfolders, images_paths) in zip(to_scan, scanned):
+                    self.folders[folder_path] = [mtime, subfolders, images_paths]
+                    changed_folders.append(folder_path)
+                level = [s for folder_path in level for s in self.folders[folder_path][1]]
+        finally:
+            if pool is not None:
+                pool.close()
+        # Folders which have been removed also count as changes
+        changed_folders += [f for f in old_folders if f not in self.folders]
+        return changed_folders
+
+
+def encode_paths(paths):
+    """Return the utf-8 encoded paths concatenated in a uint8 array, and their int64 offsets."""
+    encoded_paths = [p.encode("utf-8") for p in paths]
+    buffer = np.frombuffer(b"".join(encoded_paths), dtype=np.uint8)
+    offsets = np.cumsum([0] + [len(p) for p in encoded_paths], dtype=np.int64)
+    return buffer, offsets
+
+
+def decode_paths(buffer, offsets, buffer_start=0):
+    """Inverse of encode_paths(), optionally starting from buffer_start within buffer."""
+    data = buffer[buffer_start : buffer_start + offsets[-1]].tobytes() if len(offsets) > 0 else b""
+    return [data[offsets[i] : offsets[i+1]].decode("utf-8") for i in range(len(offsets) - 1)]
@@ -0,0 +1,102 @@
+
+import os
+import hashlib
+import logging
+import numpy as np
+from PIL import Image
+from PIL import ImageFile
+from tqdm import tqdm
+from multiprocessing import Pool
+
+from datasets.atomic_folder import atomic_folder
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+IMAGE_SHAPE = (224, 224, 3)
+
+
+class ImageShards:
+    """Training images, already decoded and stored as uint8 arrays of shape [images_num, 224, 224, 3]
+    within a few large .npy shards, so that reading an image is a memory-mapped copy, without any
+    JPEG decoding nor opening of small files.
+    The i-th image is the i-th image of the TrainCache the shards were built from, and since images
+    are sorted by class within the cache, each shard contains whole classes.
+        shards_offsets : int64, the images of the s-th shard are those in [shards_offsets[s], shards_offsets[s+1]).
+        images_hash : uint8, the sha1 of the images paths of the TrainCache, to check that the cache didn't change.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.shards_offsets = np.load(os.path.join(folder, "shards_offsets.npy"))
+        images_hash_path = os.path.join(folder, "images_hash.npy")
+        # Shards built before the hash was saved never match, and have to be built again
+        self.images_hash = np.load(images_hash_path) if os.path.exists(images_hash_path) else None
+        self.shards = [None] * (len(self.shards_offsets) - 1)  # Shards are mapped only when first needed
+
+    def __getstate__(self):
+        return {"folder": self.folder}
+
+    def __setstate__(self, state):
+        self.__init__(state["folder"])
+
+    def __len__(self):
+        return int(self.shards_offsets[-1])
+
+    def matches(self, train_cache):
+        """Return True if the shards have been built from this cache."""
+        return self.images_hash is not None and np.array_equal(self.images_hash, get_images_hash(train_cache))
+
+    def get_image(self, image_num):
+        """Return the image as a uint8 array of shape [224, 224, 3] (i.e. np.asarray(pil_image))."""
+        shard_num = int(np.searchsorted(self.shards_offsets, image_num, side="right")) - 1
+        if self.shards[shard_num] is None:
+            self.shards[shard_num] = np.load(os.path.join(self.folder, f"shard_{shard_num:05d}.npy"), mmap_mode="r")
+        return self.shards[shard_num][image_num - self.shards_offsets[shard_num]]
+
+    @staticmethod
+    def build(train_cache, folder, images_per_shard=10000, processes=1):
+        """Decode all images of train_cache and save them within folder. Shards contain at least
+        images_per_shard images (except the last one), and their boundaries are aligned to classes.
+        """
+        classes_offsets = np.asarray(train_cache.classes_offsets)
+        shards_offsets = [0]
+        for class_end in classes_offsets[1:]:
+            if class_end - shards_offsets[-1] >= images_per_shard or class_end == classes_offsets[-1]:
+                shards_offsets.append(int(class_end))
+        shards_offsets = np.array(shards_offsets, dtype=np.int64)
+        images_num = int(shards_offsets[-1])
+        logging.info(f"Decoding {images_num} images into {len(shards_offsets) - 1} shards in {folder}")
+
+        images_paths = (train_cache.get_image_path(i) for i in range(images_num))
+        pool = Pool(processes) if processes > 1 else None
+        try:
+            with atomic_folder(folder) as tmp_folder:
+                images = pool.imap(load_image_array, images_paths, chunksize=64) if pool is not None \
+                    else map(load_image_array, images_paths)
+                images = iter(tqdm(images, total=images_num, ncols=100))
+                for shard_num, (start, end) in enumerate(zip(shards_offsets[:-1], shards_offsets[1:])):
+                    shard = np.lib.format.open_memmap(os.path.join(tmp_folder, f"shard_{shard_num:05d}.npy"), mode="w+",
+                                                      dtype=np.uint8, shape=(end - start, *IMAGE_SHAPE))
+                    for i in range(end - start):
+                        shard[i] = next(images)
+                    shard.flush()
+                    del shard
+                np.save(os.path.join(tmp_folder, "shards_offsets.npy"), shards_offsets)
+                np.save(os.path.join(tmp_folder, "images_hash.npy"), get_images_hash(train_cache))
+        finally:
+            if pool is not None:
+                pool.close()
+
+
+def get_images_hash(train_cache):
+    """Return the sha1 (as a uint8 array) of the paths of all images of train_cache, in their order."""
+    hasher = hashlib.sha1()
+    hasher.update(np.ascontiguousarray(train_cache.images_offsets).tobytes())
+    hasher.update(np.ascontiguousarray(train_cache.images_paths).tobytes())
+    return np.frombuffer(hasher.digest(), dtype=np.uint8)
+
+
+def load_image_array(path):
+    image = np.asarray(Image.open(path).convert("RGB"))
+    if image.shape != IMAGE_SHAPE:
+        raise ValueError(f"Image {path} should have shape {list(IMAGE_SHAPE)} but has {list(image.shape)}.")
+    return image
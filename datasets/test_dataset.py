@@ -1,18 +1,27 @@
 
 import os
+import copy
+import hashlib
+import logging
 import numpy as np
-from glob import glob
 from os.path import join  
 from PIL import Image
 import torch.utils.data as data
 import torchvision.transforms as transforms
 from sklearn.neighbors import NearestNeighbors
 
+from datasets.train_cache import get_paths_fields
+from datasets.atomic_folder import save_arrays
+from datasets.folder_manifest import FolderManifest, encode_paths, decode_paths
+
 def open_image(path):
     return Image.open(path).convert("RGB")
 
 
 class TestDataset(data.Dataset):
+    CACHE_ARRAYS_NAMES = ["database_paths", "database_offsets", "queries_paths", "queries_offsets",
+                          "database_utms", "queries_utms", "positives_indptr", "positives_indices"]
+    
     def __init__(self, dataset_folder, database_folder="database", queries_folder="queries", positive_dist_threshold=25):         # positive_dist_threshold viene passato come argomento da tastiera
         """Dataset with images from database and queries, used for validation and test.
         Parameters
@@ -42,22 +51,15 @@ class TestDataset(data.Dataset):
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),    # stessa mean e std del train
         ])
         
-        #### Read paths and UTM coordinates for all images.
-        self.database_paths = sorted(glob(os.path.join(self.database_folder, "**", "*.jpg"), recursive=True))   # prende i path in ordine alfabetico che matchano
-        self.queries_paths = sorted(glob(os.path.join(self.queries_folder, "**", "*.jpg"),  recursive=True))
-        
-        # The format must be path/to/file/@utm_easting@utm_northing@...@.jpg
-        self.database_utms = np.array([(path.split("@")[1], path.split("@")[2]) for path in self.database_paths]).astype(float)  # prende  utmeast e utmnorth
-        self.queries_utms = np.array([(path.split("@")[1], path.split("@")[2]) for path in self.queries_paths]).astype(float)
+        # Paths, UTMs and positives are cached, and the cache is reused as long as the content of the
+        # database and queries folders doesn't change (checked through the mtimes of their subfolders)
+        cache_hash = hashlib.sha1(f"{os.path.abspath(self.database_folder)}_{os.path.abspath(self.queries_folder)}".encode()).hexdigest()
+        cache_folder = f"cache/{self.dataset_name}_{cache_hash[:16]}_pdt{positive_dist_threshold}"
+        if not self.load_cache(cache_folder):
+            self.index_folders(positive_dist_threshold)
+            os.makedirs("cache", exist_ok=True)
+            self.save_cache(cache_folder)
         
-        # Find positives_per_query, which are within positive_dist_threshold (default 25 meters)
-        knn = NearestNeighbors(n_jobs=-1)           # da sklearn.neighbors. Restituisce un oggetto in grado di implementare neighbor searches. n_jobs=-1 significa che userà
-                                                    # tutti i processori.
-        knn.fit(self.database_utms)                 # allena il NearestNeighbors con le immagini del database
-        self.positives_per_query = knn.radius_neighbors(self.queries_utms,                  # trova i vicini all'interno di un dato raggio (25 mt di defualt) con centro un punto (la query) e ne ritorna 
-                                                        radius=positive_dist_threshold,     # gli indici (solo gli indici e non le distanze perché return_distance=False)
-                                                        return_distance=False)
-
         # Da quel che ho capito, il NearestNeighbors viene allenato sul dataset in cui ogni sample è un vettore (utmeast, utmnorth). Dopodiché vengono inserite le query come samples di test
         # e per ogni dato di test (quindi ogni query), all'interno del raggio dato vengono restituiti gli indici dei sample del dataset vicini (almeno di 25 mt)
 
@@ -67,6 +69,102 @@ class TestDataset(data.Dataset):
         self.database_num = len(self.database_paths)                # restituisce il numero di paths (di immagini) del database
         self.queries_num = len(self.queries_paths)
     
+    def index_folders(self, positive_dist_threshold):
+        """Read paths and UTM coordinates for all images, and compute the positives of each query."""
+        self.database_manifest = FolderManifest()
+        self.database_manifest.update(self.database_folder)
+        self.queries_manifest = FolderManifest()
+        self.queries_manifest.update(self.queries_folder)
+        self.database_paths = self.database_manifest.get_images_paths()      # prende i path in ordine alfabetico che matchano
+        self.queries_paths = self.queries_manifest.get_images_paths()
+        
+        # The format must be path/to/file/@utm_easting@utm_northing@...@.jpg
+        self.database_utms = get_paths_fields([p.encode("utf-8") for p in self.database_paths], [1, 2])   # prende  utmeast e utmnorth
+        self.queries_utms = get_paths_fields([p.encode("utf-8") for p in self.queries_paths], [1, 2])
+        
+        # Find positives_per_query, which are within positive_dist_threshold (default 25 meters)
+        knn = NearestNeighbors(n_jobs=-1)           # da sklearn.neighbors. Restituisce un oggetto in grado di implementare neighbor searches. n_jobs=-1 significa che userà
+                                                    # tutti i processori.
+        knn.fit(self.database_utms)                 # allena il NearestNeighbors con le immagini del database
+        positives_per_query = knn.radius_neighbors(self.queries_utms,                       # trova i vicini all'interno di un dato raggio (25 mt di defualt) con centro un punto (la query) e ne ritorna 
+                                                   radius=positive_dist_threshold,          # gli indici (solo gli indici e non le distanze perché return_distance=False)
+                                                   return_distance=False)
+        # Positives are stored in CSR format: the (sorted) positives of the i-th query are
+        # positives_indices[positives_indptr[i] : positives_indptr[i+1]]
+        self.positives_indptr = np.zeros(len(positives_per_query) + 1, dtype=np.int64)
+        self.positives_indptr[1:] = np.cumsum([len(p) for p in positives_per_query])
+        if len(positives_per_query) > 0:
+            self.positives_indices = np.concatenate([np.sort(p) for p in positives_per_query]).astype(np.int64)
+        else:
+            self.positives_indices = np.zeros(0, dtype=np.int64)
+    
+    def load_cache(self, cache_folder):
+        """Load paths, UTMs and positives from cache_folder. Return False if the cache doesn't
+        exist or if the content of the database or queries folders changed since it was saved."""
+        if not (FolderManifest.exists(cache_folder, "database_manifest_") and
+                FolderManifest.exists(cache_folder, "queries_manifest_")):
+            return False
+        self.database_manifest = FolderManifest.load(cache_folder, "database_manifest_")
+        self.queries_manifest = FolderManifest.load(cache_folder, "queries_manifest_")
+        if len(self.database_manifest.update(self.database_folder)) > 0 or \
+                len(self.queries_manifest.update(self.queries_folder)) > 0:
+            logging.info(f"The images in {self.dataset_folder} changed, cache {cache_folder} will be re-created")
+            return False
+        arrays = {name: np.load(os.path.join(cache_folder, f"{name}.npy")) for name in self.CACHE_ARRAYS_NAMES}
+        self.database_paths = decode_paths(arrays["database_paths"], arrays["database_offsets"])
+        self.queries_paths = decode_paths(arrays["queries_paths"], arrays["queries_offsets"])
+        self.database_utms, self.queries_utms = arrays["database_utms"], arrays["queries_utms"]
+        self.positives_indptr, self.positives_indices = arrays["positives_indptr"], arrays["positives_indices"]
+        logging.debug(f"Using cached test dataset {cache_folder}")
+        return True
+    
+    def save_cache(self, cache_folder):
+        database_paths, database_offsets = encode_paths(self.database_paths)
+        queries_paths, queries_offsets = encode_paths(self.queries_paths)
+        arrays = {
+            "database_paths": database_paths, "database_offsets": database_offsets,
+            "queries_paths": queries_paths, "queries_offsets": queries_offsets,
+            "database_utms": self.database_utms, "queries_utms": self.queries_utms,
+            "positives_indptr": self.positives_indptr, "positives_indices": self.positives_indices,
+        }
+        for prefix, manifest in [("database_manifest_", self.database_manifest), ("queries_manifest_", self.queries_manifest)]:
+            arrays.update({f"{prefix}{name}": array for name, array in manifest.get_arrays().items()})
+        save_arrays(cache_folder, arrays)
+    
+    def get_subset(self, queries_fraction, cell_size=500):
+        """Return a TestDataset with a fixed subset of queries_fraction of the queries, stratified in
+        space: queries are sorted by cells of cell_size meters, and sampled at regular intervals.
+        The database contains the positives of the selected queries, and the same fraction of the
+        other database images (sampled with a fixed seed), which act as distractors.
+        """
+        queries_num = max(1, round(self.queries_num * queries_fraction))
+        cells = np.floor(self.queries_utms / cell_size).astype(np.int64)
+        spatial_order = np.lexsort((self.queries_utms[:, 1], self.queries_utms[:, 0], cells[:, 1], cells[:, 0]))
+        positions = np.floor((np.arange(queries_num) + 0.5) * self.queries_num / queries_num).astype(np.int64)
+        queries_indices = np.sort(spatial_order[positions])
+        
+        positives_starts, positives_ends = self.positives_indptr[queries_indices], self.positives_indptr[queries_indices + 1]
+        positives = [self.positives_indices[start : end] for start, end in zip(positives_starts, positives_ends)]
+        is_positive = np.zeros(self.database_num, dtype=bool)
+        is_positive[np.concatenate(positives + [np.zeros(0, dtype=np.int64)])] = True
+        others = np.flatnonzero(~is_positive)
+        distractors = np.random.default_rng(0).choice(others, round(len(others) * queries_fraction), replace=False)
+        database_indices = np.sort(np.concatenate([np.flatnonzero(is_positive), distractors]))
+        
+        subset = copy.copy(self)
+        subset.dataset_name = f"{self.dataset_name}_subset{queries_fraction}"
+        subset.database_paths = [self.database_paths[i] for i in database_indices]
+        subset.queries_paths = [self.queries_paths[i] for i in queries_indices]
+        subset.database_utms = self.database_utms[database_indices]
+        subset.queries_utms = self.queries_utms[queries_indices]
+        # Positives are all within the subset, their indices are mapped to those of the subset database
+        subset.positives_indptr = np.concatenate([[0], np.cumsum([len(p) for p in positives])]).astype(np.int64)
+        subset.positives_indices = np.searchsorted(database_indices, np.concatenate(positives + [np.zeros(0, dtype=np.int64)]))
+        subset.images_paths = subset.database_paths + subset.queries_paths
+        subset.database_num = len(subset.database_paths)
+        subset.queries_num = len(subset.queries_paths)
+        return subset
+    
     def __getitem__(self, index):
         image_path = self.images_paths[index]                       # prende il path dato l'index
         pil_img = open_image(image_path)                            # apre l'immagine con PIL e la restituisce in RGB
@@ -79,6 +177,20 @@ class TestDataset(data.Dataset):
     def __repr__(self):
         return f"< {self.dataset_name} - #q: {self.queries_num}; #db: {self.database_num} >"        # restiuisce info sul database sottoforma di stringa
     
+    def get_queries_sizes(self):
+        """Return the (width, height) of each query. Only the header of each image is read."""
+        sizes = []
+        for path in self.queries_paths:
+            with Image.open(path) as pil_img:
+                sizes.append(pil_img.size)
+        return sizes
+    
     def get_positives(self):
-        return self.positives_per_query                              # ritorna la lista di positvi per ogni query (la query è l'indice)
+        positives_per_query = np.empty(self.queries_num, dtype=object)
+        positives_per_query[:] = np.split(self.positives_indices, self.positives_indptr[1:-1])
+        return positives_per_query                                   # ritorna la lista di positvi per ogni query (la query è l'indice)
+    
+    def get_positives_csr(self):
+        """Return the positives of all queries in CSR format, as (indptr, indices)."""
+        return self.positives_indptr, self.positives_indices
 
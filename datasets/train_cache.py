@@ -0,0 +1,145 @@
+
+import os
+import numpy as np
+
+from datasets.atomic_folder import save_arrays
+
+
+class TrainCache:
+    """Compact representation of the training set, made only of flat NumPy arrays:
+        images_paths : uint8, all the images paths (utf-8 encoded) concatenated.
+        images_offsets : int64, the path of the i-th image is images_paths[images_offsets[i] : images_offsets[i+1]].
+            Images are sorted by class, and by path within each class.
+        classes_ids : int64 [classes_num, 3], the (UTM east, UTM north, heading) of each class.
+        classes_offsets : int64, the images of the c-th class are those in [classes_offsets[c], classes_offsets[c+1]).
+            Classes are sorted by group, and within each group they are in the same order as in the
+            previous (torch.save) cache, so that the c-th class (i.e. the c-th row of a classifier) is unchanged.
+        groups_ids : int64 [groups_num, 3], the id of each group.
+        groups_offsets : int64, the classes of the g-th group are those in [groups_offsets[g], groups_offsets[g+1]).
+    The arrays are saved as .npy files within a folder and memory-mapped when loaded, so that
+    DataLoader workers share them without copying them (unlike Python lists and dicts, whose
+    refcounts are written to when accessed, breaking copy-on-write).
+    """
+    ARRAYS_NAMES = ["images_paths", "images_offsets", "classes_ids", "classes_offsets", "groups_ids", "groups_offsets"]
+
+    def __init__(self, folder):
+        self.folder = folder
+        for name in self.ARRAYS_NAMES:
+            setattr(self, name, np.load(os.path.join(folder, f"{name}.npy"), mmap_mode="r"))
+
+    def __getstate__(self):
+        # Only pickle the folder (e.g. when DataLoader workers are spawned), arrays are re-mapped from disk
+        return {"folder": self.folder}
+
+    def __setstate__(self, state):
+        self.__init__(state["folder"])
+
+    @property
+    def groups_num(self):
+        return len(self.groups_ids)
+
+    def get_image_path(self, image_num):
+        start, end = self.images_offsets[image_num], self.images_offsets[image_num+1]
+        return self.images_paths[start : end].tobytes().decode("utf-8")
+
+    @staticmethod
+    def save(folder, encoded_paths, images_classes_ids, images_groups_ids, min_images_per_class, extra_arrays=None):
+        """Build the cache and save it within folder.
+        Parameters
+        ----------
+        encoded_paths : list of bytes, sorted and utf-8 encoded paths of all images.
+        images_classes_ids : int array [images_num, 3], the class_id of each image.
+        images_groups_ids : int array [images_num, 3], the group_id of each image.
+        min_images_per_class : int, classes with less images are discarded.
+        extra_arrays : dict, other arrays to save within folder (e.g. the manifest of the dataset folder).
+        """
+        # Unique classes are sorted by class_id, images_classes[i] is the class of the i-th image
+        classes_ids, images_classes, images_per_class = np.unique(images_classes_ids, axis=0,
+                                                                  return_inverse=True, return_counts=True)
+        images_classes = images_classes.reshape(-1)  # Some NumPy versions return a 2D inverse with axis=0
+        is_kept_image = images_per_class[images_classes] >= min_images_per_class  # Skip classes with too few images
+        kept_images = np.flatnonzero(is_kept_image)
+        
+        # Groups are sorted by their first appearance among the (sorted) images of the kept classes
+        groups_ids, groups_first_image, images_groups = np.unique(images_groups_ids[kept_images], axis=0,
+                                                                  return_index=True, return_inverse=True)
+        images_groups = images_groups.reshape(-1)
+        groups_ranks = np.argsort(np.argsort(groups_first_image, kind="stable"), kind="stable")
+        groups_ids = groups_ids[np.argsort(groups_first_image, kind="stable")]
+        
+        # Classes are sorted by group. All images of a class belong to the same group, so the group
+        # of a class is the group of any of its images.
+        kept_classes, classes_first_images = np.unique(images_classes[kept_images], return_index=True)
+        classes_groups_ranks = np.empty(len(classes_ids), dtype=np.int64)
+        classes_groups_ranks[images_classes[kept_images]] = groups_ranks[images_groups]
+        # Within each group, the previous cache had the classes in the order of list(set), with class ids
+        # added in order of first appearance among the images: the same set is built again to get that order
+        groups_classes = [[] for _ in range(len(groups_ids))]
+        for class_num in kept_classes[np.argsort(classes_first_images, kind="stable")]:
+            groups_classes[classes_groups_ranks[class_num]].append(class_num)
+        kept_classes = []
+        for group_classes in groups_classes:
+            classes_nums = {tuple(classes_ids[c].tolist()): c for c in group_classes}
+            classes_set = set()
+            for class_id in classes_nums:
+                classes_set.add(class_id)  # Added one by one (not with set(...)), so that the table grows as before
+            kept_classes.extend(classes_nums[class_id] for class_id in classes_set)
+        kept_classes = np.array(kept_classes, dtype=np.int64)
+        classes_positions = np.empty(len(classes_ids), dtype=np.int64)
+        classes_positions[kept_classes] = np.arange(len(kept_classes))
+        
+        # Images are sorted by class, and by path within each class
+        sorted_images = kept_images[np.argsort(classes_positions[images_classes[kept_images]], kind="stable")]
+        sorted_paths = [encoded_paths[i] for i in sorted_images]
+        paths_lengths = np.array([len(p) for p in sorted_paths], dtype=np.int64)
+        arrays = {
+            "images_paths": np.frombuffer(b"".join(sorted_paths), dtype=np.uint8),
+            "images_offsets": np.concatenate([[0], np.cumsum(paths_lengths)]).astype(np.int64),
+            "classes_ids": classes_ids[kept_classes].astype(np.int64).reshape(-1, 3),
+            "classes_offsets": np.concatenate([[0], np.cumsum(images_per_class[kept_classes])]).astype(np.int64),
+            "groups_ids": groups_ids.astype(np.int64).reshape(-1, 3),
+            "groups_offsets": np.concatenate([[0], np.cumsum(np.bincount(classes_groups_ranks[kept_classes],
+                                                                         minlength=len(groups_ids)))]).astype(np.int64),
+        }
+        save_arrays(folder, {**arrays, **(extra_arrays or {})})
+
+
+def get_paths_fields(encoded_paths, fields_nums):
+    """Return a float64 array [paths_num, len(fields_nums)], with the fields of each path,
+    where fields are separated by "@" (i.e. the same as float(path.split("@")[field_num])).
+    All paths are parsed at once with NumPy, instead of splitting each path in Python.
+    """
+    buffer = np.frombuffer(b"".join(encoded_paths), dtype=np.uint8)
+    paths_ends = np.cumsum([len(p) for p in encoded_paths], dtype=np.int64)
+    paths_starts = paths_ends - np.array([len(p) for p in encoded_paths], dtype=np.int64)
+    separators = np.flatnonzero(buffer == ord("@"))
+    # Index (within separators) of the first separator of each path, and number of separators per path
+    first_separators = np.searchsorted(separators, paths_starts)
+    separators_nums = np.searchsorted(separators, paths_ends) - first_separators
+    if len(encoded_paths) > 0 and separators_nums.min() < max(fields_nums):
+        bad_path = encoded_paths[int(np.argmin(separators_nums))].decode("utf-8")
+        raise ValueError(f"Image {bad_path} should have at least {max(fields_nums)} fields separated by @")
+    
+    fields = np.empty((len(encoded_paths), len(fields_nums)), dtype=np.float64)
+    for i, field_num in enumerate(fields_nums):
+        if field_num == 0:
+            starts = paths_starts
+        else:
+            starts = separators[first_separators + field_num - 1] + 1
+        has_end_separator = field_num < separators_nums
+        ends = np.where(has_end_separator, separators[np.minimum(first_separators + field_num, len(separators) - 1)], paths_ends)
+        fields[:, i] = parse_floats(buffer, starts, ends)
+    return fields
+
+
+def parse_floats(buffer, starts, ends):
+    """Parse the floats in buffer[starts[i] : ends[i]] for each i, by gathering them in a
+    fixed-width bytes array which NumPy converts to float in a single call.
+    """
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.float64)
+    width = max(int((ends - starts).max()), 1)
+    chars_indices = starts[:, None] + np.arange(width)
+    chars = buffer[np.minimum(chars_indices, len(buffer) - 1)]
+    chars[chars_indices >= ends[:, None]] = 0  # Trailing null bytes are ignored by the bytes dtype
+    return np.ascontiguousarray(chars).view(f"S{width}").reshape(-1).astype(np.float64)
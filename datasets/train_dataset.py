@@ -4,11 +4,13 @@ import torch
 import random
 import logging
 import numpy as np
-from glob import glob
 from PIL import Image
 from PIL import ImageFile
 import torchvision.transforms as T
-from collections import defaultdict
+
+from datasets.image_shards import ImageShards
+from datasets.folder_manifest import FolderManifest
+from datasets.train_cache import TrainCache, get_paths_fields
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -17,7 +19,8 @@ def open_image(path):
 
 
 class TrainDataset(torch.utils.data.Dataset):           # ogni dataset fa riferimento ad un unico gruppo
-    def __init__(self, args, dataset_folder, M=10, alpha=30, N=5, L=2, current_group=0, min_images_per_class=10):
+    def __init__(self, args, dataset_folder, M=10, alpha=30, N=5, L=2, current_group=0, min_images_per_class=10,
+                 train_cache=None, train_shards=None):
         """
         Parameters (please check our paper for a clearer explanation of the parameters).
         ----------
@@ -29,6 +32,10 @@ class TrainDataset(torch.utils.data.Dataset):           # ogni dataset fa riferi
         L : int, distance (alpha-wise) between two classes of the same group.
         current_group : int, which one of the groups to consider.
         min_images_per_class : int, minimum number of image in a class.
+        train_cache : TrainCache, the cache returned by TrainDataset.load_cache(), which can be shared
+            by the datasets of all groups. If None, it is loaded (and created if needed).
+        train_shards : ImageShards, the pre-decoded images of train_cache (see build_shards.py).
+            If None, images are read from their JPEG files.
         """
         super().__init__()
         self.M = M                                          # lunghezza della cella
@@ -39,27 +46,17 @@ class TrainDataset(torch.utils.data.Dataset):           # ogni dataset fa riferi
         self.dataset_folder = dataset_folder
         self.augmentation_device = args.augmentation_device
         
-        # dataset_name should be either "processed", "small" or "raw", if you're using SF-XL
-        dataset_name = os.path.basename(args.dataset_folder)        # resituisce la parte finale del path (cartella o file)
-        filename = f"cache/{dataset_name}_M{M}_N{N}_mipc{min_images_per_class}.torch"
-        if not os.path.exists(filename):                            # se non esiste un dataset già fatto con questi settaggi, lo crea
-            os.makedirs("cache", exist_ok=True)
-            logging.info(f"Cached dataset {filename} does not exist, I'll create it now.")
-            self.initialize(dataset_folder, M, N, alpha, L, min_images_per_class, filename)
-        elif current_group == 0:
-            logging.info(f"Using cached dataset {filename}")
-        
-
-        # pare che i settaggi siano stati fatti per ogni combinazione di filename, pertanto
-        # basta caricarlo e avere il numero di classi per gruppo e il numero di immagini
-
-        classes_per_group, self.images_per_class = torch.load(filename)
-        if current_group >= len(classes_per_group):
-            raise ValueError(f"With this configuration there are only {len(classes_per_group)} " +
+        if train_cache is None:
+            train_cache = TrainDataset.load_cache(args, dataset_folder, M, alpha, N, L, min_images_per_class)
+        self.cache = train_cache                                    # array memory-mapped, condivisi tra i gruppi e tra i worker senza copie
+        if current_group >= self.cache.groups_num:
+            raise ValueError(f"With this configuration there are only {self.cache.groups_num} " +
                              f"groups, therefore I can't create the {current_group}th group. " +
                              "You should reduce the number of groups by setting for example " +
                              f"'--groups_num {current_group}'")
-        self.classes_ids = classes_per_group[current_group]
+        # The classes of a group are contiguous within the cache, so each group is just a range over them
+        self.classes_ids = range(self.cache.groups_offsets[current_group], self.cache.groups_offsets[current_group+1])
+        self.shards = train_shards
         
         if self.augmentation_device == "cpu":
             self.transform = T.Compose([
@@ -75,78 +72,129 @@ class TrainDataset(torch.utils.data.Dataset):           # ogni dataset fa riferi
         # This function takes as input the class_num instead of the index of
         # the image. This way each class is equally represented during training.
         
-        class_id = self.classes_ids[class_num]
-
-        # Pick a random image among those in this class.
-        image_path = random.choice(self.images_per_class[class_id])
-        
-        try:
-            pil_image = open_image(image_path)          # prova ad aprire l'immagine
-        except Exception as e:
-            logging.info(f"ERROR image {image_path} couldn't be opened, it might be corrupted.")
-            raise e
+        image_num = self.get_random_image_num(class_num)
+        image_path = self.cache.get_image_path(image_num)
         # In PyTorch, images are represented as [channels, height, width], so a color image would be [3, 256, 256].
         # During the training you will get batches of images, so your shape in the forward method will get an additional batch dimension at dim0: [batch_size, channels, height, width].
-        tensor_image = T.functional.to_tensor(pil_image)                # trasforma l'immagine in un tensore
-        assert tensor_image.shape == torch.Size([3, 224, 224]), \
-            f"Image {image_path} should have shape [3, 224, 224] but has {tensor_image.shape}."     # si assicura abbia la dimensione corretta
+        tensor_image = self.get_uint8_image(image_num, image_path).float().div(255)     # trasforma l'immagine in un tensore, come to_tensor()
         
         if self.augmentation_device == "cpu":
             tensor_image = self.transform(tensor_image)       # gli applica la trasformazione definita prima
         
         return tensor_image, class_num, image_path
     
+    def get_uint8_item(self, class_num):
+        """Same as __getitem__, but return the image as a uint8 tensor (without augmentations)
+        and without its path, which is what workers of commons.SharedMemoryBatchLoader need."""
+        image_num = self.get_random_image_num(class_num)
+        return self.get_uint8_image(image_num, self.cache.get_image_path(image_num)), class_num
+    
+    def get_random_image_num(self, class_num):
+        class_index = self.classes_ids[class_num]
+        # Pick a random image among those in this class.
+        return random.randrange(self.cache.classes_offsets[class_index], self.cache.classes_offsets[class_index+1])
+    
+    def get_uint8_image(self, image_num, image_path):
+        """Return the image as a uint8 tensor with shape [3, 224, 224]."""
+        if self.shards is not None:
+            image_array = np.array(self.shards.get_image(image_num))    # already decoded
+        else:
+            try:
+                image_array = np.array(open_image(image_path))            # prova ad aprire l'immagine
+            except Exception as e:
+                logging.info(f"ERROR image {image_path} couldn't be opened, it might be corrupted.")
+                raise e
+        tensor_image = torch.from_numpy(image_array).permute(2, 0, 1)
+        assert tensor_image.shape == torch.Size([3, 224, 224]), \
+            f"Image {image_path} should have shape [3, 224, 224] but has {tensor_image.shape}."     # si assicura abbia la dimensione corretta
+        return tensor_image
+    
     def get_images_num(self):
         """Return the number of images within this group."""
-        return sum([len(self.images_per_class[c]) for c in self.classes_ids])
+        return int(self.cache.classes_offsets[self.classes_ids.stop] - self.cache.classes_offsets[self.classes_ids.start])
     
     def __len__(self):
         """Return the number of classes within this group."""
         return len(self.classes_ids)
     
     @staticmethod
-    def initialize(dataset_folder, M, N, alpha, L, min_images_per_class, filename):
-        logging.debug(f"Searching training images in {dataset_folder}")
+    def load_cache(args, dataset_folder, M=10, alpha=30, N=5, L=2, min_images_per_class=10):
+        """Load the cache with the training set, creating it if it doesn't exist.
+        The returned TrainCache can be passed to the TrainDataset of each group, so that it is loaded only once.
+        """
+        # dataset_name should be either "processed", "small" or "raw", if you're using SF-XL
+        dataset_name = os.path.basename(args.dataset_folder)        # resituisce la parte finale del path (cartella o file)
+        filename = f"cache/{dataset_name}_M{M}_N{N}_mipc{min_images_per_class}"
+        processes = max(1, args.num_workers)
+        if not os.path.exists(filename):                            # se non esiste un dataset già fatto con questi settaggi, lo crea
+            os.makedirs("cache", exist_ok=True)
+            logging.info(f"Cached dataset {filename} does not exist, I'll create it now.")
+            TrainDataset.initialize(dataset_folder, M, N, alpha, L, min_images_per_class, filename, processes=processes)
+        else:
+            logging.info(f"Using cached dataset {filename}")
+            if FolderManifest.exists(filename):
+                # Only the folders which changed since the cache was built are listed again
+                manifest = FolderManifest.load(filename)
+                changed_folders = manifest.update(dataset_folder, processes)
+                if len(changed_folders) > 0:
+                    logging.info(f"{len(changed_folders)} folders changed since {filename} was created, I'll update it now.")
+                    TrainDataset.build_cache(manifest, M, N, alpha, L, min_images_per_class, filename)
         
-        images_paths = sorted(glob(f"{dataset_folder}/**/*.jpg", recursive=True))       # trova tutte le immagini per il training (che matchano quel path)
-        logging.debug(f"Found {len(images_paths)} images")                              # recursive=True permette di cercare nelle subfolder
+        # pare che i settaggi siano stati fatti per ogni combinazione di filename, pertanto
+        # basta caricarlo e avere il numero di classi per gruppo e il numero di immagini
+        return TrainCache(filename)
+    
+    @staticmethod
+    def load_shards(args, train_cache):
+        """Load the shards in args.train_shards_folder (None if it is not set), which can be passed
+        to the TrainDataset of each group."""
+        if args.train_shards_folder is None:
+            return None
+        if not os.path.exists(args.train_shards_folder):
+            raise FileNotFoundError(f"Folder {args.train_shards_folder} does not exist, you can create it with build_shards.py")
+        train_shards = ImageShards(args.train_shards_folder)
+        if not train_shards.matches(train_cache):
+            raise ValueError(f"The shards in {args.train_shards_folder} have been built from a different cache "
+                             f"than {train_cache.folder}, you should build them again with build_shards.py")
+        logging.info(f"Reading training images from the shards in {args.train_shards_folder}")
+        return train_shards
+    
+    @staticmethod
+    def initialize(dataset_folder, M, N, alpha, L, min_images_per_class, filename, processes=1):
+        logging.debug(f"Searching training images in {dataset_folder} with {processes} processes")
+        manifest = FolderManifest()
+        manifest.update(dataset_folder, processes)                                      # trova tutte le immagini per il training, elencando le cartelle in parallelo
+        TrainDataset.build_cache(manifest, M, N, alpha, L, min_images_per_class, filename)
+    
+    @staticmethod
+    def build_cache(manifest, M, N, alpha, L, min_images_per_class, filename):
+        """Build the cache from all the images within the manifest, and save it (together with the manifest) in filename."""
+        images_paths = manifest.get_images_paths()
+        logging.debug(f"Found {len(images_paths)} images")
         
         logging.debug("For each image, get its UTM east, UTM north and heading from its path")
-        images_metadatas = [p.split("@") for p in images_paths]                         # i metadati delle immagini sono già nel loro nome
-
         # field 1 is UTM east, field 2 is UTM north, field 9 is heading  (negli altri ci sono altre informazioni tipo la data)
-
-        utmeast_utmnorth_heading = [(m[1], m[2], m[9]) for m in images_metadatas]       # posizione dei metadati importanti per ogni immagine
-        utmeast_utmnorth_heading = np.array(utmeast_utmnorth_heading).astype(np.float)  # fa un array dalla lista
+        encoded_paths = [p.encode("utf-8") for p in images_paths]
+        utmeast_utmnorth_heading = get_paths_fields(encoded_paths, [1, 2, 9])          # parsing di tutti i path in blocco con NumPy
         
         logging.debug("For each image, get class and group to which it belongs")
-        class_id__group_id = [TrainDataset.get__class_id__group_id(*m, M, alpha, N, L)  # inserisce metadata e attributi della classe per ottenere
-                              for m in utmeast_utmnorth_heading]                        # group e class id dei relatavi metadati (immagine)
-        
-        logging.debug("Group together images belonging to the same class")
-        images_per_class = defaultdict(list)                                            
-        for image_path, (class_id, _) in zip(images_paths, class_id__group_id):         # image path è preso da images_paths, è il primo membro di class_id__group_id
-            images_per_class[class_id].append(image_path)                               # dizionario che ha per key la classe e come value la lista di immagini
+        classes_ids, groups_ids = TrainDataset.get__classes_ids__groups_ids(utmeast_utmnorth_heading, M, alpha, N, L)
         
-        # Images_per_class is a dict where the key is class_id, and the value
-        # is a list with the paths of images within that class.
-        images_per_class = {k: v for k, v in images_per_class.items() if len(v) >= min_images_per_class}    # dict comprehension. Prende solo le classi di una 
-                                                                                                            # certa grandezza
-        logging.debug("Group together classes belonging to the same group")
-        # Classes_per_group is a dict where the key is group_id, and the value
-        # is a list with the class_ids belonging to that group.
-        classes_per_group = defaultdict(set)
-        for class_id, group_id in class_id__group_id:
-            if class_id not in images_per_class:
-                continue  # Skip classes with too few images
-            classes_per_group[group_id].add(class_id)                   # come value ha in realtà un set. Qui nel nostro caso avremo solo un gruppo
-                                                                        # e le relative classi
-        
-        # Convert classes_per_group to a list of lists.
-        # Each sublist represents the classes within a group.
-        classes_per_group = [list(c) for c in classes_per_group.values()]   # lista di liste in cui l'arg è il gruppo e la sublist è il numero di classi di quel gruppo
-        
-        torch.save((classes_per_group, images_per_class), filename)
+        logging.debug("Group together images belonging to the same class, and classes belonging to the same group")
+        manifest_arrays = {f"manifest_{name}": array for name, array in manifest.get_arrays().items()}
+        TrainCache.save(filename, encoded_paths, classes_ids, groups_ids, min_images_per_class, extra_arrays=manifest_arrays)
+    
+    @staticmethod
+    def get__classes_ids__groups_ids(utmeast_utmnorth_heading, M, alpha, N, L):
+        """Vectorized version of get__class_id__group_id(), which computes the class_id and
+        group_id of all images at once. utmeast_utmnorth_heading has shape [images_num, 3],
+        and the two returned int64 arrays have shape [images_num, 3].
+        """
+        cell_sizes = np.array([M, M, alpha])
+        # Rounded to nearest lower multiple of M (or alpha for the heading)
+        classes_ids = (np.floor_divide(utmeast_utmnorth_heading, cell_sizes) * cell_sizes).astype(np.int64)
+        groups_ids = classes_ids % (cell_sizes * np.array([N, N, L])) // cell_sizes
+        return classes_ids, groups_ids
     
     @staticmethod
     def get__class_id__group_id(utm_east, utm_north, heading, M, alpha, N, L):
@@ -1,5 +1,7 @@
 
 import sys
+import copy
+import time
 import torch
 import logging
 import multiprocessing
@@ -9,6 +11,8 @@ import test
 import parser
 import commons
 from model import network
+from model.exporting import load_exported_model
+from pca_whitening import PCAWhitening
 from datasets.test_dataset import TestDataset
 
 torch.backends.cudnn.benchmark = True  # Provides a speedup
@@ -23,22 +27,45 @@ logging.info(f"Arguments: {args}")
 logging.info(f"The outputs are being saved in {output_folder}")
 
 #### Model
-model = network.GeoLocalizationNet(args.backbone, args.fc_output_dim)
-
 logging.info(f"There are {torch.cuda.device_count()} GPUs and {multiprocessing.cpu_count()} CPUs.")
 
-if args.resume_model is not None:
-    logging.info(f"Loading model from {args.resume_model}")
-    model_state_dict = torch.load(args.resume_model)
-    model.load_state_dict(model_state_dict)
+if args.exported_model is not None:
+    logging.info(f"Loading exported model from {args.exported_model}")
+    model = load_exported_model(args.exported_model, args.device)
 else:
-    logging.info("WARNING: You didn't provide a path to resume the model (--resume_model parameter). " +
-                 "Evaluation will be computed using randomly initialized weights.")
+    model = network.GeoLocalizationNet(args.backbone, args.fc_output_dim)
+    if args.resume_model is not None:
+        logging.info(f"Loading model from {args.resume_model}")
+        model_state_dict = torch.load(args.resume_model)
+        model.load_state_dict(model_state_dict)
+    else:
+        logging.info("WARNING: You didn't provide a path to resume the model (--resume_model parameter). " +
+                     "Evaluation will be computed using randomly initialized weights.")
 
 model = model.to(args.device)
 
 test_ds = TestDataset(args.test_set_folder, queries_folder="queries",
                       positive_dist_threshold=args.positive_dist_threshold)
 
-recalls, recalls_str = test.test(args, test_ds, model)
-logging.info(f"{test_ds}: {recalls_str}")
+whitening = None
+if args.pca_whitening is not None:
+    logging.info(f"Loading PCA-whitening from {args.pca_whitening}")
+    whitening = PCAWhitening.load(args.pca_whitening)
+elif args.pca_dim is not None:
+    whitening = PCAWhitening.fit(test.get_database_descriptors(args, test_ds, model), args.pca_dim)
+    whitening.save(f"{output_folder}/pca_whitening.npz")
+    logging.info(f"Saved PCA-whitening to {args.pca_dim} dimensions in {output_folder}/pca_whitening.npz")
+
+test_start_time = time.time()
+recalls, recalls_str = test.test(args, test_ds, model, whitening)
+logging.info(f"{test_ds}: {recalls_str} - test time: {time.time() - test_start_time:.1f} s")
+
+if args.compare_fp32:
+    fp32_args = copy.copy(args)
+    fp32_args.infer_amp, fp32_args.infer_channels_last = False, False
+    fp32_args.faiss_index, fp32_args.faiss_search_params = "Flat", ""
+    test_start_time = time.time()
+    fp32_recalls, fp32_recalls_str = test.test(fp32_args, test_ds, model)
+    logging.info(f"{test_ds} in float32 without compression: {fp32_recalls_str} - test time: {time.time() - test_start_time:.1f} s")
+    logging.info("Recalls difference with float32 without compression: " +
+                 ", ".join([f"R@{val}: {rec - fp32_rec:+.1f}" for val, rec, fp32_rec in zip(test.RECALL_VALUES, recalls, fp32_recalls)]))
@@ -0,0 +1,74 @@
+
+import os
+import sys
+import copy
+import torch
+import logging
+from datetime import datetime
+
+import test
+import parser
+import commons
+from model import network
+from model.exporting import quantize_backbone, export_torchscript, export_onnx, load_exported_model
+from datasets.test_dataset import TestDataset
+
+# Exports a trained model as a frozen TorchScript and/or ONNX graph for inference, e.g.
+# python export.py --resume_model logs/.../best_model.pth --export_format both --export_int8
+# and evaluates the exported models on the test set, to compare their recalls with the original model
+
+args = parser.parse_arguments(is_training=False)
+start_time = datetime.now()
+output_folder = f"logs/{args.save_dir}/{start_time.strftime('%Y-%m-%d_%H-%M-%S')}"
+commons.make_deterministic(args.seed)
+commons.setup_logging(output_folder, console="info")
+logging.info(" ".join(sys.argv))
+logging.info(f"Arguments: {args}")
+logging.info(f"The outputs are being saved in {output_folder}")
+
+if args.resume_model is None:
+    raise ValueError("You should set parameter --resume_model to the model to export")
+if args.export_int8 and args.export_format != "torchscript":
+    raise ValueError("--export_int8 is only supported with --export_format torchscript")
+
+#### Model
+model = network.GeoLocalizationNet(args.backbone, args.fc_output_dim)
+logging.info(f"Loading model from {args.resume_model}")
+model.load_state_dict(torch.load(args.resume_model, map_location="cpu"))
+model = model.eval()
+
+test_ds = TestDataset(args.test_set_folder, queries_folder="queries",
+                      positive_dist_threshold=args.positive_dist_threshold)
+
+#### Export
+exported_paths = []
+if args.export_format in ["torchscript", "both"]:
+    if args.export_int8:
+        # Calibrated only on database images, which are available before any query comes
+        database_ds = torch.utils.data.Subset(test_ds, list(range(test_ds.database_num)))
+        quantized_model = quantize_backbone(model, database_ds, images_num=args.calibration_images_num,
+                                            batch_size=args.infer_batch_size)
+        exported_paths.append(os.path.join(output_folder, "model_int8.pt"))
+        export_torchscript(quantized_model, exported_paths[-1])
+    else:
+        exported_paths.append(os.path.join(output_folder, "model.pt"))
+        export_torchscript(copy.deepcopy(model).to(args.device), exported_paths[-1])
+if args.export_format in ["onnx", "both"]:
+    exported_paths.append(os.path.join(output_folder, "model.onnx"))
+    export_onnx(copy.deepcopy(model), exported_paths[-1])
+for path in exported_paths:
+    logging.info(f"Exported model saved in {path} ({os.path.getsize(path) / 2**20:.1f} MB)")
+
+#### Test
+model = model.to(args.device)
+recalls, recalls_str = test.test(args, test_ds, model)
+logging.info(f"Original model on {test_ds}: {recalls_str}")
+for path in exported_paths:
+    # Quantized and ONNX models only run on CPU
+    exported_args = copy.copy(args)
+    if path.endswith(".onnx") or args.export_int8:
+        exported_args.device = "cpu"
+    exported_model = load_exported_model(path, exported_args.device)
+    exported_recalls, exported_recalls_str = test.test(exported_args, test_ds, exported_model)
+    logging.info(f"{os.path.basename(path)} on {test_ds}: {exported_recalls_str}")
+    logging.info(f"{os.path.basename(path)} R@1 difference: {exported_recalls[0] - recalls[0]:+.1f}")
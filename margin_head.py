@@ -0,0 +1,100 @@
+
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn import Parameter
+
+# Default (s, m) of each loss function
+MARGIN_HEADS_DEFAULTS = {
+    "cosface": (30, 0.4),
+    "arcface": (30, 0.4),
+    "sphereface": (30, 3),
+}
+
+
+class MarginHead(nn.Module):
+    """Classifier with a large margin loss, which returns the cross-entropy loss directly:
+    Args:
+        in_features: size of each input sample
+        out_features: size of each output sample (i.e. number of classes)
+        loss_function: one of "cosface", "arcface" or "sphereface"
+        s: norm of input feature
+        m: margin
+        sample_ratio: fraction of classes used at each training step (sampled softmax). The classes
+            of the batch are always used, and the others are sampled randomly. With sample_ratio < 1
+            the gradient of the weight is sparse, so it should be optimized with torch.optim.SparseAdam,
+            which only updates the rows of the classes used at each step.
+    The margin only changes the logit of the target class, so it is computed only for the B target
+    columns, which are then written within the B×C logits: no other B×C tensor is built.
+    Inputs are expected to be L2-normalized already (as the descriptors of GeoLocalizationNet).
+    """
+    def __init__(self, in_features: int, out_features: int, loss_function: str = "cosface",
+                 s: float = None, m: float = None, sample_ratio: float = 1.0):
+        super().__init__()
+        if loss_function not in MARGIN_HEADS_DEFAULTS:
+            raise ValueError(f"loss_function should be one of {list(MARGIN_HEADS_DEFAULTS)}, not {loss_function}")
+        default_s, default_m = MARGIN_HEADS_DEFAULTS[loss_function]
+        self.in_features = in_features
+        self.out_features = out_features
+        self.loss_function = loss_function
+        self.s = default_s if s is None else s
+        self.m = default_m if m is None else m
+        self.sample_ratio = sample_ratio
+        self.weight = Parameter(torch.Tensor(out_features, in_features))
+        nn.init.xavier_uniform_(self.weight)
+
+    def forward(self, inputs: torch.Tensor, label: torch.Tensor) -> torch.Tensor:
+        if self.training and self.sample_ratio < 1:
+            return self.forward_sampled(inputs, label)
+        return F.cross_entropy(self.get_logits(inputs, label), label)
+
+    def forward_sampled(self, inputs: torch.Tensor, label: torch.Tensor) -> torch.Tensor:
+        classes_num = min(self.out_features, max(round(self.out_features * self.sample_ratio), len(label)))
+        # Classes of the batch have a higher score than any other class, so they are always sampled
+        scores = torch.rand(self.out_features, device=label.device)
+        scores[label] = 2.
+        sampled_classes = scores.topk(classes_num, sorted=False).indices.sort().values
+        sampled_label = torch.searchsorted(sampled_classes, label)
+        # The sampled rows are gathered with a sparse gradient, so that only them are updated
+        sampled_weight = F.embedding(sampled_classes, self.weight, sparse=True)
+        return F.cross_entropy(self.compute_logits(inputs, sampled_label, sampled_weight), sampled_label)
+
+    def get_logits(self, inputs: torch.Tensor, label: torch.Tensor) -> torch.Tensor:
+        """Return the logits of all classes, with the margin applied."""
+        return self.compute_logits(inputs, label, self.weight)
+
+    def compute_logits(self, inputs: torch.Tensor, label: torch.Tensor, weight: torch.Tensor) -> torch.Tensor:
+        weight = F.normalize(weight, dim=1)  # Normalized once per step
+        logits = torch.mm(inputs, weight.t()).mul_(self.s)
+        # The target cosines are computed again from the target weights (instead of being gathered
+        # from the logits), so that the logits can be overwritten in place
+        target_cosine = (inputs * weight[label]).sum(dim=1)
+        target_logits = self.s * self.get_target_cosine_with_margin(target_cosine)
+        logits.scatter_(1, label.view(-1, 1), target_logits.view(-1, 1).to(logits.dtype))
+        return logits
+
+    def get_target_cosine_with_margin(self, cosine: torch.Tensor) -> torch.Tensor:
+        if self.loss_function == "cosface":
+            return cosine - self.m
+        # For ArcFace and SphereFace the margin is applied to the angle, and gradients only flow through cosine
+        with torch.no_grad():
+            theta = torch.acos(cosine.clamp(-1+1e-5, 1-1e-5))
+            if self.loss_function == "arcface":
+                m_theta = (theta + self.m).clamp(1e-5, 3.14159)
+                d_theta = torch.cos(m_theta) - cosine
+            else:  # sphereface
+                m_theta = theta * self.m
+                k = (m_theta / math.pi).floor()
+                sign = -2 * torch.remainder(k, 2) + 1  # (-1)**k
+                d_theta = sign * torch.cos(m_theta) - 2. * k - cosine
+        return cosine + d_theta
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' \
+               + 'in_features=' + str(self.in_features) \
+               + ', out_features=' + str(self.out_features) \
+               + ', loss_function=' + self.loss_function \
+               + ', s=' + str(self.s) \
+               + ', m=' + str(self.m) \
+               + ', sample_ratio=' + str(self.sample_ratio) + ')'
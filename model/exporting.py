@@ -0,0 +1,111 @@
+
+import os
+import copy
+import hashlib
+import logging
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import DataLoader, Dataset, Subset
+
+# Exported models take a batch of normalized images [B, 3, H, W] and return L2-normalized descriptors.
+# H and W can change from batch to batch, since queries can have different resolutions.
+EXAMPLE_INPUT_SHAPE = (1, 3, 512, 512)
+
+
+def quantize_backbone(model: nn.Module, calibration_ds: Dataset, images_num: int = 512,
+                      batch_size: int = 16) -> nn.Module:
+    """Return a copy of model (on CPU) whose backbone is quantized to int8 with static quantization,
+    calibrating its activations on the first images_num images of calibration_ds.
+    Only the backbone (which holds nearly all the FLOPs) is quantized, the aggregation (GeM, FC
+    and L2 normalizations) stays in float32, so that descriptors keep their precision.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    model = copy.deepcopy(model).cpu().eval()
+    example_inputs = (torch.randn(EXAMPLE_INPUT_SHAPE),)
+    backbone = prepare_fx(model.backbone, get_default_qconfig_mapping("x86"), example_inputs)
+    calibration_subset = Subset(calibration_ds, list(range(min(images_num, len(calibration_ds)))))
+    logging.info(f"Calibrating the int8 backbone on {len(calibration_subset)} images")
+    with torch.no_grad():
+        for images, _ in DataLoader(calibration_subset, batch_size=batch_size):
+            backbone(images)
+    model.backbone = convert_fx(backbone)
+    return model
+
+
+def export_torchscript(model: nn.Module, path: str):
+    """Save model as a traced and frozen TorchScript graph."""
+    model = model.eval()
+    example_input = torch.randn(EXAMPLE_INPUT_SHAPE, device=next(model.parameters()).device)
+    with torch.no_grad():
+        scripted_model = torch.jit.freeze(torch.jit.trace(model, example_input))
+    torch.jit.save(scripted_model, path)
+
+
+def export_onnx(model: nn.Module, path: str, opset_version: int = 17):
+    """Save model as an ONNX graph, with dynamic batch size and resolution."""
+    model = model.cpu().eval()
+    with torch.no_grad():
+        torch.onnx.export(model, torch.randn(EXAMPLE_INPUT_SHAPE), path, opset_version=opset_version,
+                          input_names=["images"], output_names=["descriptors"],
+                          dynamic_axes={"images": {0: "batch", 2: "height", 3: "width"}, "descriptors": {0: "batch"}})
+
+
+class ExportedModel(nn.Module):
+    """Model saved by export.py, usable in place of GeoLocalizationNet (e.g. by test.test).
+    Weights of exported models are frozen within their graph, so its state_dict only holds the
+    hash of the exported file, so that cached descriptors and indexes of different models are never mixed up.
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        with open(path, "rb") as file:
+            digest = hashlib.sha1(file.read()).digest()
+        self.register_buffer("file_hash", torch.tensor(list(digest), dtype=torch.uint8))
+
+
+class TorchScriptModel(ExportedModel):
+    def __init__(self, path: str, device: str = "cpu"):
+        super().__init__(path)
+        self.model = torch.jit.load(path, map_location=device)
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        return self.model(images)
+
+
+class OnnxModel(ExportedModel):
+    """ONNX model run with ONNX Runtime on CPU."""
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.session = create_onnx_session(path)
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        descriptors = self.session.run(None, {"images": images.cpu().numpy()})[0]
+        return torch.from_numpy(np.ascontiguousarray(descriptors, dtype=np.float32)).to(images.device)
+
+    def __getstate__(self):
+        # The ONNX Runtime session can't be pickled, so it is created again when unpickled
+        state = self.__dict__.copy()
+        del state["session"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.session = create_onnx_session(self.path)
+
+
+def create_onnx_session(path: str):
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("Evaluating an ONNX model requires onnxruntime (pip install onnxruntime)")
+    return onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+
+def load_exported_model(path: str, device: str = "cpu") -> ExportedModel:
+    """Load a model saved by export.py: a TorchScript model (.pt) or an ONNX model (.onnx)."""
+    if os.path.splitext(path)[1] == ".onnx":
+        return OnnxModel(path)
+    return TorchScriptModel(path, device)
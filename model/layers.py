@@ -6,10 +6,11 @@ from torch.nn.parameter import Parameter
 
 
 def gem(x, p=torch.ones(1)*3, eps: float = 1e-6):
-    return F.avg_pool2d(x.clamp(min=eps).pow(p), (x.size(-2), x.size(-1))).pow(1./p)
+    # Same as an avg_pool2d with a kernel as large as x, but without sizes baked into traced/ONNX graphs
+    return x.clamp(min=eps).pow(p).mean(dim=(-2, -1), keepdim=True).pow(1./p)
         # clamp() -> taglia tutti gli elementi tra [min, max] in questo caso solo per min
         # size() -> restituisce un oggetto di classe torch.Size con le dimensioni del tensore
-        # avg_pool2d() -> applica una average-pooling 2D lungo l'input tensor in base alla dimensione del kernel (singolo numero o tupla)
+        # mean() -> media lungo le due dimensioni spaziali, cioè un average-pooling 2D con kernel grande quanto l'input tensor
 
 
 class GeM(nn.Module):
@@ -29,9 +29,31 @@ def parse_arguments(is_training: bool = True):
     parser.add_argument("--lr", type=float, default=0.00001, help="_")
     parser.add_argument("--classifiers_lr", type=float, default=0.01, help="_")
     parser.add_argument("--loss_function", type=str, default="cosface",
+                        choices=["cosface", "arcface", "sphereface"],
                         help="type of loss function: cosface, arcface or sphereface")                       # Aggiunto per cambiarel loss
+    parser.add_argument("--classifiers_sample_ratio", type=float, default=1,
+                        help="fraction of the classes of the group used by the classifier at each iteration "
+                             "(sampled softmax): classes within the batch are always used, the others are sampled. "
+                             "With values < 1 classifiers are optimized with SparseAdam")
+    parser.add_argument("--compact_idle_classifiers", action="store_true",
+                        help="keep the classifiers of idle groups (and save them in checkpoints) with bfloat16 weights "
+                             "and int8 Adam moments, and expand them when their group comes up")
+    parser.add_argument("--loss_sync_iterations", type=int, default=100,
+                        help="how often (in iterations) to read the running loss from the device to show it, "
+                             "since reading it makes the CPU wait for the GPU")
+    parser.add_argument("--loss_history", action="store_true",
+                        help="keep the loss of every iteration of the epoch on device, e.g. to plot it with "
+                             "epoch_losses.get_history(). By default only the running mean is kept")
     parser.add_argument("--loss_weight", type=float, default=1,
                         help="weight of CosFace loss")
+    parser.add_argument("--shared_memory_loader", action="store_true",
+                        help="load training batches as uint8 images written by workers in a shared memory ring buffer, "
+                             "and convert them to float on device. Requires --augmentation_device cuda")
+    parser.add_argument("--train_shards_folder", type=str, default=None,
+                        help="folder with the training images decoded into uint8 shards, built with build_shards.py. "
+                             "If None, images are read from their JPEG files")
+    parser.add_argument("--images_per_shard", type=int, default=10000,
+                        help="minimum number of images within each shard built by build_shards.py")
     # Data augmentation
     parser.add_argument("--brightness", type=float, default=0.7, help="_")
     parser.add_argument("--contrast", type=float, default=0.7, help="_")
@@ -41,8 +63,77 @@ def parse_arguments(is_training: bool = True):
     # Validation / test parameters
     parser.add_argument("--infer_batch_size", type=int, default=16,
                         help="Batch size for inference (validating and testing)")
+    parser.add_argument("--val_queries_fraction", type=float, default=1,
+                        help="fraction of the validation queries used after each epoch, stratified in space, "
+                             "with a matching subset of the database. With values < 1 (or with --background_validation) "
+                             "best_model.pth is selected at the end of training, by validating the "
+                             "--val_candidates_num best epochs on the full validation set")
+    parser.add_argument("--background_validation", action="store_true",
+                        help="validate a snapshot of the weights in a background thread (and CUDA stream), "
+                             "while the next epoch is trained")
+    parser.add_argument("--val_candidates_num", type=int, default=3,
+                        help="number of epochs validated on the full validation set to select best_model.pth, "
+                             "with --val_queries_fraction < 1 or --background_validation")
+    parser.add_argument("--queries_infer_batch_size", type=int, default=1,
+                        help="Batch size for queries inference. Queries can have different resolutions, "
+                             "so with batch size > 1 only queries with the same size are batched together")
+    parser.add_argument("--infer_amp", action="store_true",
+                        help="extract descriptors with autocast, in float16 on CUDA and bfloat16 on CPU. "
+                             "Descriptors can also be stored in reduced precision by the index, "
+                             "e.g. with --faiss_index SQfp16 or SQ8")
+    parser.add_argument("--infer_channels_last", action="store_true",
+                        help="extract descriptors with the channels_last memory format, faster with convolutions "
+                             "on tensor cores and on recent CPUs")
+    parser.add_argument("--compare_fp32", action="store_true",
+                        help="with eval.py, also evaluate in float32 with a Flat index and without PCA-whitening, "
+                             "and report the recalls difference")
+    parser.add_argument("--extraction_processes", type=int, default=1,
+                        help="with --device cpu, number of processes which extract descriptors in parallel, "
+                             "each with its own replica of the model and a shard of the images")
+    parser.add_argument("--extraction_threads", type=int, default=None,
+                        help="number of intra-op threads of each extraction process. "
+                             "If None, the CPU cores are split evenly among the processes")
     parser.add_argument("--positive_dist_threshold", type=int, default=25,
                         help="distance in meters for a prediction to be considered a positive")
+    parser.add_argument("--descriptors_cache_folder", type=str, default=None,
+                        help="folder where to cache the database descriptors, which are reused "
+                             "as long as model weights and database images don't change. "
+                             "If None, descriptors are always re-extracted. Not used by validations during training")
+    parser.add_argument("--tmp_folder", type=str, default=None,
+                        help="folder of the temporary memory-mapped descriptors files. If None, the "
+                             "descriptors cache folder is used if given, otherwise the system temporary folder")
+    parser.add_argument("--streaming_extraction", action="store_true",
+                        help="add database descriptors to the FAISS index (or to a memory-mapped file) as soon as "
+                             "they are extracted, so that they are never all kept in RAM")
+    parser.add_argument("--faiss_index", type=str, default="Flat",
+                        help="FAISS index factory string used for retrieval, e.g. Flat (exhaustive search), "
+                             "IVF1024,Flat, IVF1024,PQ64 or HNSW32")
+    parser.add_argument("--faiss_search_params", type=str, default="",
+                        help="FAISS search-time parameters, e.g. nprobe=16 for IVF or efSearch=128 for HNSW")
+    parser.add_argument("--faiss_train_size", type=int, default=100000,
+                        help="number of database descriptors used to train the FAISS index (if it needs training)")
+    parser.add_argument("--faiss_index_folder", type=str, default=None,
+                        help="folder where to save trained FAISS indexes, which are reused as long as "
+                             "model weights and database images don't change. Not used by validations during training")
+    parser.add_argument("--pca_dim", type=int, default=None,
+                        help="fit a PCA-whitening to this dimension on database descriptors (of the validation set with "
+                             "train.py, of the test set with eval.py), save it as pca_whitening.npz in the output folder "
+                             "(next to best_model.pth with train.py), "
+                             "and apply it before indexing and search")
+    parser.add_argument("--pca_whitening", type=str, default=None,
+                        help="path of a PCA-whitening to apply with eval.py, e.g. logs/.../pca_whitening.npz")
+    # Export parameters
+    parser.add_argument("--export_format", type=str, default="torchscript",
+                        choices=["torchscript", "onnx", "both"],
+                        help="format of the inference model saved by export.py")
+    parser.add_argument("--export_int8", action="store_true",
+                        help="quantize the backbone of the exported model to int8 (static quantization, "
+                             "for CPU inference), calibrated on database images. Only with TorchScript")
+    parser.add_argument("--calibration_images_num", type=int, default=512,
+                        help="number of database images used to calibrate the int8 quantization")
+    parser.add_argument("--exported_model", type=str, default=None,
+                        help="path of a model saved by export.py (.pt or .onnx) to evaluate with eval.py "
+                             "instead of --resume_model")
     # GeoWarp parameters
     parser.add_argument("--k", type=int, default=0.6,
                         help="parameter k, defining the difficulty of ss training data")
@@ -89,6 +180,10 @@ def parse_arguments(is_training: bool = True):
         raise FileNotFoundError(f"Folder {args.dataset_folder} does not exist")
     
     if is_training:
+        if args.shared_memory_loader and args.augmentation_device != "cuda":
+            raise ValueError("--shared_memory_loader requires --augmentation_device cuda, because "
+                             "images are augmented and normalized after being loaded")
+        
         args.train_set_folder = os.path.join(args.dataset_folder, "train")
         if not os.path.exists(args.train_set_folder):
             raise FileNotFoundError(f"Folder {args.train_set_folder} does not exist")
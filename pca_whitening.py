@@ -0,0 +1,73 @@
+
+import hashlib
+import logging
+import faiss
+import numpy as np
+
+
+class PCAWhitening:
+    """PCA-whitening of descriptors to a lower dimension: x -> normalize(projection @ (x - mean)),
+    where the rows of projection are the principal components with the largest variance, each
+    divided by the square root of its variance.
+        mean : float32 [in_dim], the mean of the descriptors it has been fit on.
+        projection : float32 [dim, in_dim].
+    """
+    def __init__(self, mean: np.ndarray, projection: np.ndarray):
+        self.mean = np.ascontiguousarray(mean, dtype=np.float32)
+        self.projection = np.ascontiguousarray(projection, dtype=np.float32)
+
+    @property
+    def dim(self) -> int:
+        return self.projection.shape[0]
+
+    @staticmethod
+    def fit(descriptors: np.ndarray, dim: int, eps: float = 1e-6, chunk_size: int = 65536) -> "PCAWhitening":
+        """Fit on descriptors [descriptors_num, in_dim], which are read in chunks so that they
+        can be memory-mapped. eps avoids dividing by (almost) null variances."""
+        descriptors_num, in_dim = descriptors.shape
+        if not 0 < dim <= min(in_dim, descriptors_num):
+            raise ValueError(f"The PCA dimension should be between 1 and {min(in_dim, descriptors_num)}, not {dim}")
+        logging.debug(f"Fitting PCA-whitening from {in_dim} to {dim} dimensions on {descriptors_num} descriptors")
+        descriptors_sum = np.zeros(in_dim, dtype=np.float64)
+        second_moment = np.zeros((in_dim, in_dim), dtype=np.float64)
+        for start in range(0, descriptors_num, chunk_size):
+            chunk = np.asarray(descriptors[start : start+chunk_size], dtype=np.float64)
+            descriptors_sum += chunk.sum(axis=0)
+            second_moment += chunk.T @ chunk
+        mean = descriptors_sum / descriptors_num
+        covariance = (second_moment - descriptors_num * np.outer(mean, mean)) / max(descriptors_num - 1, 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)  # Sorted by increasing eigenvalue
+        eigenvalues, eigenvectors = eigenvalues[::-1][:dim], eigenvectors[:, ::-1][:, :dim]
+        projection = eigenvectors.T / np.sqrt(np.maximum(eigenvalues, 0) + eps)[:, None]
+        return PCAWhitening(mean, projection)
+
+    def wrap_faiss_index(self, faiss_index: faiss.Index) -> faiss.Index:
+        """Return an index which whitens and L2-normalizes descriptors before passing them to
+        faiss_index (of dimension self.dim), for training, adding and searching alike.
+        The returned index owns faiss_index, and can be saved with faiss.write_index."""
+        linear_transform = faiss.LinearTransform(len(self.mean), self.dim, True)
+        faiss.copy_array_to_vector(self.projection.ravel(), linear_transform.A)
+        faiss.copy_array_to_vector((-self.projection @ self.mean).astype(np.float32), linear_transform.b)
+        linear_transform.is_trained = True
+        normalization = faiss.NormalizationTransform(self.dim, 2.0)
+        whitened_index = faiss.IndexPreTransform(normalization, faiss_index)
+        whitened_index.prepend_transform(linear_transform)
+        # Transforms and faiss_index are freed by whitened_index, not by their Python wrappers
+        whitened_index.own_fields = True
+        for owned in [linear_transform, normalization, faiss_index]:
+            owned.this.disown()
+        return whitened_index
+
+    def get_hash(self) -> str:
+        hasher = hashlib.sha1()
+        hasher.update(self.mean.tobytes())
+        hasher.update(self.projection.tobytes())
+        return hasher.hexdigest()
+
+    def save(self, path: str):
+        np.savez(path, mean=self.mean, projection=self.projection)
+
+    @staticmethod
+    def load(path: str) -> "PCAWhitening":
+        arrays = np.load(path)
+        return PCAWhitening(arrays["mean"], arrays["projection"])
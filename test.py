@@ -1,73 +1,479 @@
 
+import os
+import re
+import copy
+import contextlib
+import math
+import time
 import faiss
+import threading
+import tempfile
 import torch
+import torch.multiprocessing as mp
+import hashlib
 import logging
 import numpy as np
 from tqdm import tqdm
-from typing import Tuple
+from typing import List, Tuple
 from argparse import Namespace
 from torch.utils.data.dataset import Subset
-from torch.utils.data import DataLoader, Dataset
+from collections import defaultdict
+from torch.utils.data import DataLoader, Dataset, Sampler
 import torchvision.transforms as transforms
 from PIL import Image
 
+from pca_whitening import PCAWhitening
+
 # Compute R@1, R@5, R@10, R@20
 RECALL_VALUES = [1, 5, 10, 20]
 
-def test(args: Namespace, eval_ds: Dataset, model: torch.nn.Module) -> Tuple[np.ndarray, str]:
-    """Compute descriptors of the given dataset and compute the recalls."""
+def test(args: Namespace, eval_ds: Dataset, model: torch.nn.Module,
+         whitening: PCAWhitening = None) -> Tuple[np.ndarray, str]:
+    """Compute descriptors of the given dataset and compute the recalls.
+    If whitening is given, descriptors are PCA-whitened by the FAISS index before indexing and search."""
     
     model = model.eval()                                                        # si mette il modello in evaluation mode
+    if args.infer_channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    cache_path = index_path = None
+    if args.descriptors_cache_folder is not None or args.faiss_index_folder is not None:
+        eval_hash = get_eval_hash(args, eval_ds, model)
+        if args.descriptors_cache_folder is not None:
+            cache_path = os.path.join(args.descriptors_cache_folder, f"{eval_ds.dataset_name}_{eval_hash}.npy")
+        if args.faiss_index_folder is not None:
+            index_name = re.sub(r"[^\w]", "_", args.faiss_index)
+            if whitening is not None:
+                index_name = f"PCAW{whitening.dim}_{whitening.get_hash()[:8]}_{index_name}"
+            index_path = os.path.join(args.faiss_index_folder, f"{eval_ds.dataset_name}_{index_name}_{eval_hash}.index")
+    
+    # Use a kNN to find predictions     ----    faiss (Facebook AI Similarity Search) è una libreria di Facebook che permette di effetuare una ricerca tra somiglianze in maniera efficiente
+                                                             # di default l'indice è un faiss.IndexFlatL2, che misura la l2 distance (o distanza euclidea) tra tutti i vettori dati e il quey vector 
+    faiss_index = create_faiss_index(args, index_path, whitening)
     with torch.no_grad():                                                       # all'interno del ciclo, il gradient è disabilitato (requires_grad=False)
-        logging.debug("Extracting database descriptors for evaluation/testing")
-        database_subset_ds = Subset(eval_ds, list(range(eval_ds.database_num)))                       # subset del dataset da valutare non considerando le immagini di query
-        database_dataloader = DataLoader(dataset=database_subset_ds, num_workers=args.num_workers,
-                                         batch_size=args.infer_batch_size, pin_memory=(args.device == "cuda"))    # creazione del dataloader in grado di iterare sul dataset
-        all_descriptors = np.empty((len(eval_ds), args.fc_output_dim), dtype="float32")                           # ritorna un vettore non inizializzato con una riga per ogni sample da valutare
-        for images, indices in tqdm(database_dataloader, ncols=100):                                              # è un numero di colonne pari alla dimensione di descrittori
-            descriptors = model(images.to(args.device))                                                           # mette le immagini su device e ne calcola il risultato del MODELLO -> i descrittori
-            descriptors = descriptors.cpu().numpy()                                                               # porta i descrittori su cpu e li traforma da tensori ad array
-            all_descriptors[indices.numpy(), :] = descriptors                                                     # riempie l'array mettendo ad ogni indice il descrittore calcolato
+        if cache_path is not None and os.path.exists(cache_path):
+            logging.debug(f"Loading database descriptors from cache {cache_path}")
+            database_descriptors = np.load(cache_path, mmap_mode="r")
+            train_faiss_index(args, faiss_index, database_descriptors, index_path)
+            add_to_faiss_index(faiss_index, database_descriptors)
+        elif use_extraction_processes(args):
+            logging.debug(f"Extracting database descriptors for evaluation/testing with {args.extraction_processes} processes")
+            if cache_path is not None:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                descriptors_path = f"{cache_path}.{os.getpid()}.tmp"
+            else:
+                descriptors_path = get_temporary_path(args)
+            extract_descriptors_parallel(args, eval_ds, model, range(eval_ds.database_num), 0,
+                                         descriptors_path, args.infer_batch_size)
+            database_descriptors = np.load(descriptors_path, mmap_mode="r")
+            train_faiss_index(args, faiss_index, database_descriptors, index_path)
+            add_to_faiss_index(faiss_index, database_descriptors)
+            del database_descriptors
+            if cache_path is not None:
+                os.replace(descriptors_path, cache_path)
+                logging.debug(f"Saved database descriptors in cache {cache_path}")
+            else:
+                os.remove(descriptors_path)
+        else:
+            logging.debug("Extracting database descriptors for evaluation/testing")
+            if args.streaming_extraction:
+                extract_database_streaming(args, eval_ds, model, get_database_dataloader(args, eval_ds),
+                                           faiss_index, cache_path, index_path)
+            else:
+                database_descriptors = extract_database_descriptors(args, eval_ds, model)
+                if cache_path is not None:
+                    save_descriptors_cache(cache_path, database_descriptors)
+                train_faiss_index(args, faiss_index, database_descriptors, index_path)
+                faiss_index.add(database_descriptors)                    # dopodiché ci aggiunge tutti i descrittori delle immagini di test 
+        database_descriptors = None                                  # elimina roba non piiù utile
         
-        logging.debug("Extracting queries descriptors for evaluation/testing using batch size 1")
-        queries_infer_batch_size = 1                                                                              # sembra che venga valutata un'immagine per volta
         queries_subset_ds = Subset(eval_ds, list(range(eval_ds.database_num, eval_ds.database_num+eval_ds.queries_num)))    # in questo caso, crea un subset con sole query
-        queries_dataloader = DataLoader(dataset=queries_subset_ds, num_workers=args.num_workers,
-                                        batch_size=queries_infer_batch_size, pin_memory=(args.device == "cuda"))            # crea il dataloader associato a questo secondo subset
-        for images, indices in tqdm(queries_dataloader, ncols=100):                            
-            descriptors = model(images.to(args.device))                       # fa lo stesso lavoro precedente, calcolando per ogni immagine di query il descrittore
-            descriptors = descriptors.cpu().numpy()
-            all_descriptors[indices.numpy(), :] = descriptors                 # rimepiendo il vettore all_descriptors 
-    
-    queries_descriptors = all_descriptors[eval_ds.database_num:]              # divide i descrittori delle queries
-    database_descriptors = all_descriptors[:eval_ds.database_num]             # dai descrittori del database di immagini da classificare
-    
-    # Use a kNN to find predictions     ----    faiss (Facebook AI Similarity Search) è una libreria di Facebook che permette di effetuare una ricerca tra somiglianze in maniera efficiente
-                                                             # faiss.IndexFlatL2 misura la l2 distance (o distanza euclidea) tra tutti i vettori dati e il quey vector 
-    faiss_index = faiss.IndexFlatL2(args.fc_output_dim)      # qui sembra che lo stia inizializzando con la dimensione dei descrittori  
-    faiss_index.add(database_descriptors)                    # dopodiché ci aggiunge tutti i descrittori delle immagini di test 
-    del database_descriptors, all_descriptors                # elimina roba non piiù utile
+        if use_extraction_processes(args):
+            logging.debug(f"Extracting queries descriptors for evaluation/testing with {args.extraction_processes} processes")
+            descriptors_path = get_temporary_path(args)
+            queries_sizes = eval_ds.get_queries_sizes() if args.queries_infer_batch_size > 1 else None
+            extract_descriptors_parallel(args, eval_ds, model, range(eval_ds.database_num, eval_ds.database_num+eval_ds.queries_num),
+                                         eval_ds.database_num, descriptors_path, args.queries_infer_batch_size, queries_sizes)
+            queries_descriptors = np.load(descriptors_path)
+            os.remove(descriptors_path)
+        elif args.queries_infer_batch_size == 1:
+            logging.debug("Extracting queries descriptors for evaluation/testing using batch size 1")
+            queries_dataloader = DataLoader(dataset=queries_subset_ds, num_workers=args.num_workers,
+                                            batch_size=1, pin_memory=(args.device == "cuda"))                   # crea il dataloader associato a questo secondo subset
+        else:
+            # Queries can have different resolutions, so only queries with the same size are batched together
+            logging.debug("Extracting queries descriptors for evaluation/testing using "
+                          f"batch size {args.queries_infer_batch_size}, with queries bucketed by resolution")
+            batch_sampler = SameSizeBatchSampler(eval_ds.get_queries_sizes(), args.queries_infer_batch_size)
+            queries_dataloader = DataLoader(dataset=queries_subset_ds, num_workers=args.num_workers,
+                                            batch_sampler=batch_sampler, pin_memory=(args.device == "cuda"))
+        if not use_extraction_processes(args):
+            queries_descriptors = np.empty((eval_ds.queries_num, args.fc_output_dim), dtype="float32")
+            for descriptors, indices in extract_descriptors(args, model, queries_dataloader):
+                queries_descriptors[indices - eval_ds.database_num, :] = descriptors      # fa lo stesso lavoro precedente, rimepiendo il vettore queries_descriptors
+    if args.infer_channels_last:
+        model = model.to(memory_format=torch.contiguous_format)
     
     logging.debug("Calculating recalls")
+    search_start_time = time.time()
     _, predictions = faiss_index.search(queries_descriptors, max(RECALL_VALUES))   # effettua la ricerca con i descrittori delle query con i valori di recall specificati
                                                                         # questa parte quindi è svolta unicamente da questa libreria, che calcola la distanza euclidea (quindi la vicinanza)
                                                                         # per ogni k (preso da RECALL_VALUES) immagini con le immagini di query. Più k è alto è più ho possibilità di prendere la 
                                                                         # più vicina (lo si vede dopo)
+    search_time = time.time() - search_start_time
     #### For each query, check if the predictions are correct
-    positives_per_query = eval_ds.get_positives()               # per ogni query, restituisce l'immagine reale del dataset più vicina (credo, devo ancora guardare test_dataset)
-    recalls = np.zeros(len(RECALL_VALUES))                      # vettore di recalls inizializzato a zero
-    for query_index, preds in enumerate(predictions):           # per ogni predizione, prende indice e relativa predizione
-        for i, n in enumerate(RECALL_VALUES):                   # per ogni valore delle recall values (sono 5 valori)
-            if np.any(np.in1d(preds[:n], positives_per_query[query_index])):    # controlla che ogni valore nel primo 1Darray (quindi penso descrittore, non immagine) sia contenuto 
-                                                                                # nel secondo. Quindi per ogni n controlla se le predizioni fino ad n (le n più vicine) contengono 
-                                                                                # la relativa immagine di query (np.any -> almeno 1)
-                recalls[i:] += 1                                                # se si, aumenta la relativa recall
-                break                                                           # ed esce perché tanto l'ha già trovata. Quindi si favoriscono recall più basse
-    # Divide by queries_num and multiply by 100, so the recalls are in percentages
-    recalls = recalls / eval_ds.queries_num * 100                               # valori di recall espressi in percentuale (cioè quante query in percentuale sono cadute in quel valore di recall)   
+    positives_indptr, positives_indices = eval_ds.get_positives_csr()   # per ogni query, gli indici delle immagini del database entro positive_dist_threshold
+    recalls = compute_recalls(predictions, positives_indptr, positives_indices, eval_ds.database_num)
     recalls_str = ", ".join([f"R@{val}: {rec:.1f}" for val, rec in zip(RECALL_VALUES, recalls)])     # valori di recall in stringa
+    index_memory = estimate_index_memory(faiss_index)
+    index_name = args.faiss_index if whitening is None else f"PCAW{whitening.dim},{args.faiss_index}"
+    recalls_str += (f" - {index_name} index: ~{index_memory / 2**20:.1f} MB, "
+                    f"{search_time * 1000 / max(eval_ds.queries_num, 1):.3f} ms/query")
     return recalls, recalls_str
 
+
+def compute_recalls(predictions: np.ndarray, positives_indptr: np.ndarray,
+                    positives_indices: np.ndarray, database_num: int) -> np.ndarray:
+    """Compute the recalls (in percentage) for each value in RECALL_VALUES, in a single
+    vectorized pass. predictions has shape [queries_num, max(RECALL_VALUES)] and positives are
+    in CSR format with sorted indices within each query, as returned by get_positives_csr().
+    A query is correct at N if any of its first N predictions is a positive.
+    """
+    queries_num = len(predictions)
+    # Each (query, database image) pair is encoded as a single integer key. Since positives are
+    # sorted within each query, the positives keys are globally sorted.
+    queries_ids = np.repeat(np.arange(queries_num, dtype=np.int64), np.diff(positives_indptr))
+    positives_keys = queries_ids * database_num + positives_indices
+    predictions_keys = np.arange(queries_num, dtype=np.int64)[:, None] * database_num + predictions
+    is_positive = np.zeros(predictions.shape, dtype=bool)
+    if len(positives_keys) > 0:
+        keys_positions = np.searchsorted(positives_keys, predictions_keys).clip(max=len(positives_keys) - 1)
+        is_positive = positives_keys[keys_positions] == predictions_keys
+    is_positive &= predictions >= 0  # FAISS uses -1 for missing predictions
+    # Rank of the first correct prediction, or predictions.shape[1] if there is none
+    first_positive = np.where(is_positive.any(axis=1), is_positive.argmax(axis=1), predictions.shape[1])
+    recalls = np.array([(first_positive < n).sum() for n in RECALL_VALUES], dtype=np.float64)
+    # Divide by queries_num and multiply by 100, so the recalls are in percentages
+    return recalls / queries_num * 100
+
+
+def get_recall_confidence_interval(recall: float, queries_num: int, z: float = 1.96) -> Tuple[float, float]:
+    """Return the Wilson score interval (by default at 95%) of a recall computed on queries_num
+    queries, both in percentage."""
+    if queries_num == 0:
+        return 0., 100.
+    p = recall / 100
+    denominator = 1 + z**2 / queries_num
+    center = (p + z**2 / (2 * queries_num)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / queries_num + z**2 / (4 * queries_num**2)) / denominator
+    return (center - margin) * 100, (center + margin) * 100
+
+
+class BackgroundValidator:
+    """Run test() in a background thread (and on a separate CUDA stream), on a replica of the model
+    loaded with a snapshot of its weights, so that training can go on while validating.
+    """
+    def __init__(self, args: Namespace, eval_ds: Dataset, model: torch.nn.Module):
+        self.args = args
+        self.eval_ds = eval_ds
+        self.model = copy.deepcopy(model).eval()
+        self.stream = torch.cuda.Stream() if args.device == "cuda" else None
+        self.thread = None
+        self.result = None
+    
+    def start(self, epoch_num: int, model: torch.nn.Module):
+        """Start validating a snapshot of the current weights of model (waiting for any previous validation)."""
+        self.wait()
+        self.model.load_state_dict(model.state_dict())
+        training_stream = torch.cuda.current_stream() if self.stream is not None else None
+        self.thread = threading.Thread(target=self.validate, args=(epoch_num, training_stream), daemon=True)
+        self.thread.start()
+    
+    def validate(self, epoch_num: int, training_stream):
+        try:
+            if self.stream is None:
+                self.result = (epoch_num, *test(self.args, self.eval_ds, self.model))
+                return
+            self.stream.wait_stream(training_stream)  # The weights are copied on the training stream
+            with torch.cuda.stream(self.stream):
+                self.result = (epoch_num, *test(self.args, self.eval_ds, self.model))
+        except Exception as e:
+            self.result = e
+    
+    def wait(self):
+        """Wait for the running validation, and return (epoch_num, recalls, recalls_str, state_dict)
+        with the validated weights on CPU, or None if no validation was running."""
+        if self.thread is None:
+            return None
+        self.thread.join()
+        self.thread = None
+        result, self.result = self.result, None
+        if isinstance(result, Exception):
+            raise RuntimeError("The background validation failed") from result
+        state_dict = {k: v.detach().to("cpu", copy=True) for k, v in self.model.state_dict().items()}
+        return (*result, state_dict)
+
+
+class SameSizeBatchSampler(Sampler):
+    """Batch sampler which only puts together images with the same size, so that images
+    with different resolutions can be processed in batches without resizing or padding.
+    Batches are yielded one bucket at a time, with the indices sorted within each bucket.
+    """
+    def __init__(self, images_sizes: List[Tuple[int, int]], batch_size: int):
+        self.batches = []
+        buckets = defaultdict(list)
+        for index, size in enumerate(images_sizes):
+            buckets[size].append(index)
+        for indices in buckets.values():
+            self.batches += [indices[i : i+batch_size] for i in range(0, len(indices), batch_size)]
+    
+    def __iter__(self):
+        return iter(self.batches)
+    
+    def __len__(self):
+        return len(self.batches)
+
+
+def get_eval_hash(args: Namespace, eval_ds: Dataset, model: torch.nn.Module) -> str:
+    """Return a hash of the model weights, the backbone, fc_output_dim, the precision and the list of database
+    images. It is used to name cached descriptors and trained indexes, so that they are
+    automatically invalidated when any of these changes.
+    """
+    hasher = hashlib.sha1()
+    hasher.update(f"{args.backbone}_{args.fc_output_dim}{'_amp' if args.infer_amp else ''}".encode())
+    for name, tensor in model.state_dict().items():
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    for path in eval_ds.database_paths:
+        hasher.update(path.encode())
+    return hasher.hexdigest()
+
+
+def extract_descriptors(args: Namespace, model: torch.nn.Module, dataloader: DataLoader):
+    """Yield the descriptors of each batch, as a float32 array, and the indices of its images."""
+    for images, indices in tqdm(dataloader, ncols=100):                                     # è un numero di colonne pari alla dimensione di descrittori
+        with get_autocast(args):
+            descriptors = model(prepare_images(args, images))                               # mette le immagini su device e ne calcola il risultato del MODELLO -> i descrittori
+        yield descriptors.float().cpu().numpy(), indices.numpy()                            # porta i descrittori su cpu e li traforma da tensori ad array
+
+
+def get_autocast(args: Namespace):
+    """Return the context in which the model is run for inference: with --infer_amp, autocast
+    to float16 on CUDA and to bfloat16 on CPU (where float16 matmuls and convolutions are slow)."""
+    if not args.infer_amp:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=args.device, dtype=torch.float16 if args.device == "cuda" else torch.bfloat16)
+
+
+def prepare_images(args: Namespace, images: torch.Tensor) -> torch.Tensor:
+    memory_format = torch.channels_last if args.infer_channels_last else torch.contiguous_format
+    return images.to(args.device, memory_format=memory_format)
+
+
+def use_extraction_processes(args: Namespace) -> bool:
+    return args.device == "cpu" and args.extraction_processes > 1
+
+
+def get_temporary_path(args: Namespace, suffix: str = ".npy") -> str:
+    """Create an empty temporary file for memory-mapped descriptors, within args.tmp_folder, or within
+    args.descriptors_cache_folder if it is None (the system temporary folder is often in RAM)."""
+    folder = args.tmp_folder or args.descriptors_cache_folder
+    if folder is not None:
+        os.makedirs(folder, exist_ok=True)
+    file_descriptor, path = tempfile.mkstemp(suffix=suffix, dir=folder)
+    os.close(file_descriptor)
+    return path
+
+
+def extract_descriptors_parallel(args: Namespace, eval_ds: Dataset, model: torch.nn.Module, indices: range, first_row: int,
+                                 descriptors_path: str, batch_size: int, images_sizes: List[Tuple[int, int]] = None):
+    """Extract on CPU the descriptors of eval_ds[indices] with args.extraction_processes processes,
+    each with its own replica of the model and its own intra-op thread pool, and a contiguous
+    shard of indices. Each process writes its descriptors within descriptors_path, a float32 .npy
+    file created here and shared through memory mapping, where the descriptor of image i is at row i - first_row.
+    If images_sizes (the size of each image) is given, only images with the same size are batched together.
+    """
+    processes_num = args.extraction_processes
+    threads_num = args.extraction_threads or max(1, (os.cpu_count() or 1) // processes_num)
+    descriptors = np.lib.format.open_memmap(descriptors_path, mode="w+", dtype="float32",
+                                            shape=(len(indices), args.fc_output_dim))
+    del descriptors
+    processes = []
+    for shard in np.array_split(np.arange(indices.start, indices.stop), processes_num):
+        if len(shard) == 0:
+            continue
+        shard_sizes = [images_sizes[i - first_row] for i in shard] if images_sizes is not None else None
+        process = mp.Process(target=extraction_worker, daemon=True,
+                             args=(args, eval_ds, model, shard.tolist(), first_row, descriptors_path,
+                                   batch_size, threads_num, shard_sizes))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    if any(process.exitcode != 0 for process in processes):
+        raise RuntimeError(f"Extracting descriptors failed in {sum(p.exitcode != 0 for p in processes)} processes")
+
+
+def extraction_worker(args: Namespace, eval_ds: Dataset, model: torch.nn.Module, indices: List[int], first_row: int, descriptors_path: str,
+                      batch_size: int, threads_num: int, images_sizes: List[Tuple[int, int]] = None):
+    torch.set_num_threads(threads_num)
+    descriptors = np.load(descriptors_path, mmap_mode="r+")
+    shard_ds = Subset(eval_ds, indices)
+    if images_sizes is None:
+        dataloader = DataLoader(dataset=shard_ds, batch_size=batch_size)
+    else:
+        dataloader = DataLoader(dataset=shard_ds, batch_sampler=SameSizeBatchSampler(images_sizes, batch_size))
+    model = model.eval()
+    with torch.no_grad():
+        for images, images_indices in dataloader:
+            with get_autocast(args):
+                images_descriptors = model(prepare_images(args, images))
+            descriptors[images_indices.numpy() - first_row, :] = images_descriptors.float().numpy()
+    descriptors.flush()
+
+
+def extract_database_streaming(args: Namespace, eval_ds: Dataset, model: torch.nn.Module, database_dataloader: DataLoader,
+                               faiss_index: faiss.Index, cache_path: str = None, index_path: str = None):
+    """Extract the database descriptors and add each batch to faiss_index as soon as it is computed,
+    without ever holding all the database descriptors in RAM.
+    If the index still needs training, or the descriptors should be cached, descriptors are
+    also written to a memory-mapped file; the index is then trained on a sample of it and the
+    descriptors are added to the index in chunks.
+    """
+    shape = (eval_ds.database_num, args.fc_output_dim)
+    memmap_path = None
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        memmap_path = f"{cache_path}.{os.getpid()}.tmp"
+    elif not faiss_index.is_trained:
+        memmap_path = get_temporary_path(args)
+    database_descriptors = None
+    if memmap_path is not None:
+        database_descriptors = np.lib.format.open_memmap(memmap_path, mode="w+", dtype="float32", shape=shape)
+    
+    add_while_extracting = faiss_index.is_trained
+    for descriptors, indices in extract_descriptors(args, model, database_dataloader):
+        if database_descriptors is not None:
+            database_descriptors[indices, :] = descriptors
+        if add_while_extracting:
+            # The dataloader is not shuffled, so the ids assigned by FAISS match the database indices
+            faiss_index.add(descriptors)
+    
+    if not add_while_extracting:
+        database_descriptors.flush()
+        train_faiss_index(args, faiss_index, database_descriptors, index_path)
+        add_to_faiss_index(faiss_index, database_descriptors)
+    
+    if database_descriptors is not None:
+        database_descriptors.flush()
+        del database_descriptors
+        if cache_path is not None:
+            os.replace(memmap_path, cache_path)
+            logging.debug(f"Saved database descriptors in cache {cache_path}")
+        else:
+            os.remove(memmap_path)
+
+
+def create_faiss_index(args: Namespace, index_path: str = None, whitening: PCAWhitening = None) -> faiss.Index:
+    """Build an empty FAISS index from the factory string args.faiss_index (e.g. "Flat",
+    "IVF1024,Flat", "IVF1024,PQ64", "HNSW32"), preceded by the PCA-whitening if given.
+    If index_path exists, the already trained index is loaded from it instead.
+    """
+    if index_path is not None and os.path.exists(index_path):
+        logging.debug(f"Loading trained FAISS index from {index_path}")
+        faiss_index = faiss.read_index(index_path)
+    elif whitening is not None:
+        faiss_index = whitening.wrap_faiss_index(faiss.index_factory(whitening.dim, args.faiss_index, faiss.METRIC_L2))
+    else:
+        faiss_index = faiss.index_factory(args.fc_output_dim, args.faiss_index, faiss.METRIC_L2)
+    if args.faiss_search_params:
+        faiss.ParameterSpace().set_index_parameters(faiss_index, args.faiss_search_params)
+    return faiss_index
+
+
+def get_database_descriptors(args: Namespace, eval_ds: Dataset, model: torch.nn.Module) -> np.ndarray:
+    """Return the database descriptors of eval_ds (e.g. to fit a PCA-whitening on them), memory-mapped
+    from the descriptors cache if available, otherwise extracted (and cached, if caching is enabled)."""
+    model = model.eval()
+    cache_path = None
+    if args.descriptors_cache_folder is not None:
+        cache_path = os.path.join(args.descriptors_cache_folder, f"{eval_ds.dataset_name}_{get_eval_hash(args, eval_ds, model)}.npy")
+        if os.path.exists(cache_path):
+            return np.load(cache_path, mmap_mode="r")
+    with torch.no_grad():
+        database_descriptors = extract_database_descriptors(args, eval_ds, model)
+    if cache_path is not None:
+        save_descriptors_cache(cache_path, database_descriptors)
+    return database_descriptors
+
+
+def get_database_dataloader(args: Namespace, eval_ds: Dataset) -> DataLoader:
+    database_subset_ds = Subset(eval_ds, list(range(eval_ds.database_num)))                       # subset del dataset da valutare non considerando le immagini di query
+    return DataLoader(dataset=database_subset_ds, num_workers=args.num_workers,
+                      batch_size=args.infer_batch_size, pin_memory=(args.device == "cuda"))    # creazione del dataloader in grado di iterare sul dataset
+
+
+def extract_database_descriptors(args: Namespace, eval_ds: Dataset, model: torch.nn.Module) -> np.ndarray:
+    """Extract the database descriptors of eval_ds into a float32 array [database_num, fc_output_dim]."""
+    database_descriptors = np.empty((eval_ds.database_num, args.fc_output_dim), dtype="float32")     # ritorna un vettore non inizializzato con una riga per ogni immagine del database
+    for descriptors, indices in extract_descriptors(args, model, get_database_dataloader(args, eval_ds)):
+        database_descriptors[indices, :] = descriptors                                          # riempie l'array mettendo ad ogni indice il descrittore calcolato
+    return database_descriptors
+
+
+def train_faiss_index(args: Namespace, faiss_index: faiss.Index, database_descriptors: np.ndarray, index_path: str = None):
+    """Train faiss_index (e.g. IVF and PQ codebooks) on a random sample of args.faiss_train_size
+    database descriptors, if it needs training. If index_path is given, the trained index is saved to it.
+    """
+    if faiss_index.is_trained:
+        return
+    train_size = min(args.faiss_train_size, len(database_descriptors))
+    logging.debug(f"Training FAISS index {args.faiss_index} on {train_size} database descriptors")
+    train_indices = np.sort(np.random.default_rng(0).choice(len(database_descriptors), train_size, replace=False))
+    faiss_index.train(np.ascontiguousarray(database_descriptors[train_indices]))
+    if index_path is not None:
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        faiss.write_index(faiss_index, index_path)
+        logging.debug(f"Saved trained FAISS index in {index_path}")
+
+
+def estimate_index_memory(faiss_index: faiss.Index) -> int:
+    """Estimate the memory (in bytes) of the codes within faiss_index, plus the centroids of IVF
+    indexes, without serializing a copy of it. Graph links (e.g. of HNSW) are not counted."""
+    faiss_index = faiss.downcast_index(faiss_index)
+    if isinstance(faiss_index, faiss.IndexPreTransform):
+        return estimate_index_memory(faiss_index.index)
+    try:
+        index_memory = faiss_index.ntotal * faiss_index.sa_code_size()
+    except RuntimeError:  # Indexes without a standalone codec, e.g. HNSW
+        index_memory = faiss_index.ntotal * faiss_index.d * 4
+    ivf_index = faiss.try_extract_index_ivf(faiss_index)
+    if ivf_index is not None:
+        index_memory += estimate_index_memory(ivf_index.quantizer)
+    return index_memory
+
+
+def add_to_faiss_index(faiss_index: faiss.Index, database_descriptors: np.ndarray, chunk_size: int = 65536):
+    """Add the descriptors to the index in chunks, so that memory-mapped descriptors are never
+    entirely loaded in RAM."""
+    for start in range(0, len(database_descriptors), chunk_size):
+        faiss_index.add(np.ascontiguousarray(database_descriptors[start : start+chunk_size]))
+
+
+def save_descriptors_cache(cache_path: str, database_descriptors: np.ndarray):
+    """Save the database descriptors as a float32 .npy file, which can later be memory-mapped.
+    The file is written under a temporary name and then renamed, so that an interrupted
+    run never leaves a truncated cache behind.
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    cache = np.lib.format.open_memmap(tmp_path, mode="w+", dtype="float32", shape=database_descriptors.shape)
+    cache[:] = database_descriptors
+    cache.flush()
+    del cache
+    os.replace(tmp_path, cache_path)
+    logging.debug(f"Saved database descriptors in cache {cache_path}")
+
+
 base_transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),    # stessa mean e std del train
@@ -1,8 +1,9 @@
 
+import os
 import sys
+import copy
 import torch
 import logging
-import numpy as np
 from tqdm import tqdm
 import multiprocessing
 from datetime import datetime
@@ -18,6 +19,7 @@ import arcface_loss
 import sphereface_loss 
 import augmentations
 from model import network
+from pca_whitening import PCAWhitening
 from datasets.test_dataset import TestDataset
 from datasets.train_dataset import TrainDataset
 
@@ -49,12 +51,17 @@ if args.resume_model is not None:                              # se c'è un mode
 model = model.to(args.device).train()      # sposta il modello sulla GPU e lo mette in modalità training (alcuni layer si comporteranno di conseguenza)
 
 #### Optimizer
-criterion = torch.nn.CrossEntropyLoss()
 model_optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)  # utilizza l'algoritmo Adam per l'ottimizzazione
 
 #### Datasets
+# The cache is loaded only once, and each group is a lightweight view over it
+train_cache = TrainDataset.load_cache(args, args.train_set_folder, M=args.M, alpha=args.alpha, N=args.N, L=args.L,
+                                      min_images_per_class=args.min_images_per_class)
+train_shards = TrainDataset.load_shards(args, train_cache)
 groups = [TrainDataset(args, args.train_set_folder, M=args.M, alpha=args.alpha, N=args.N, L=args.L,
-                    current_group=n, min_images_per_class=args.min_images_per_class) for n in range(args.groups_num)]
+                    current_group=n, min_images_per_class=args.min_images_per_class, train_cache=train_cache,
+                    train_shards=train_shards)
+          for n in range(args.groups_num)]
 
 # Each group has its own classifier, which depends on the number of classes in the group (più gruppi ci sono, più classificatori sono usati con rispettivi optimizer)
 # Noi abbiamo un solo gruppo perciò avremo un solo classifier
@@ -70,15 +77,19 @@ groups = [TrainDataset(args, args.train_set_folder, M=args.M, alpha=args.alpha,
 
 logging.info(f"Using {args.loss_function} function") # dentro args.loss ho la mia loss: per settarla scrivere negli args --loss_function name quando fate partire il train
 if args.loss_function == "cosface":
-        classifiers = [cosface_loss.MarginCosineProduct(args.fc_output_dim, len(group)) for group in groups]   # il classifier è dato dalla loss(dimensione descrittore, numero di classi nel gruppo) 
+        classifiers = [cosface_loss.MarginCosineProduct(args.fc_output_dim, len(group), sample_ratio=args.classifiers_sample_ratio) for group in groups]   # il classifier è dato dalla loss(dimensione descrittore, numero di classi nel gruppo) 
 elif args.loss_function == "arcface": 
-        classifiers = [arcface_loss.ArcFace(args.fc_output_dim, len(group)) for group in groups]
+        classifiers = [arcface_loss.ArcFace(args.fc_output_dim, len(group), sample_ratio=args.classifiers_sample_ratio) for group in groups]
 elif args.loss_function == "sphereface":
-        classifiers = [sphereface_loss.SphereFace(args.fc_output_dim, len(group)) for group in groups]
+        classifiers = [sphereface_loss.SphereFace(args.fc_output_dim, len(group), sample_ratio=args.classifiers_sample_ratio) for group in groups]
 else:
     raise ValueError()
 
-classifiers_optimizers = [torch.optim.Adam(classifier.parameters(), lr=args.classifiers_lr) for classifier in classifiers] # rispettivo optimizer
+if args.classifiers_sample_ratio < 1:
+    # With sampled softmax the gradients of the classifiers are sparse, and only the rows of the sampled classes are updated
+    classifiers_optimizers = [torch.optim.SparseAdam(classifier.parameters(), lr=args.classifiers_lr) for classifier in classifiers]
+else:
+    classifiers_optimizers = [torch.optim.Adam(classifier.parameters(), lr=args.classifiers_lr) for classifier in classifiers] # rispettivo optimizer
 
 logging.info(f"Using {len(groups)} groups")                                                                                        # numero di gruppi
 logging.info(f"The {len(groups)} groups have respectively the following number of classes {[len(g) for g in groups]}")             # numero di classi nei gruppi
@@ -87,19 +98,46 @@ logging.info(f"The {len(groups)} groups have respectively the following number o
 # per capire gli output su, bisogna capire come sono state implementate le classi dei dataset
 
 val_ds = TestDataset(args.val_set_folder, positive_dist_threshold=args.positive_dist_threshold) 
-test_ds = TestDataset(args.test_set_folder, queries_folder="queries",positive_dist_threshold=args.positive_dist_threshold)
 logging.info(f"Validation set: {val_ds}")
-logging.info(f"Test set: {test_ds}")
+# The weights change at every epoch, so their database descriptors and trained indexes would never be reused:
+# they are not cached while validating
+val_args = copy.copy(args)
+val_args.descriptors_cache_folder = val_args.faiss_index_folder = None
+# With fast validation, epochs are validated on a subset of val_ds (and/or in background), and
+# best_model.pth is selected at the end of training by validating the best epochs on the whole val_ds
+fast_validation = args.val_queries_fraction < 1 or args.background_validation
+if fast_validation:
+    epochs_val_ds = val_ds.get_subset(args.val_queries_fraction) if args.val_queries_fraction < 1 else val_ds
+    logging.info(f"Validation set used after each epoch: {epochs_val_ds}")
+    val_candidates = []  # (R@1, epoch_num, state_dict) of the best epochs, sorted by R@1
+
+def add_val_candidate(epoch_num, recalls, recalls_str, state_dict, best_val_recall1):
+    """Log the recalls of an epoch validated on epochs_val_ds, keep its weights if it is one of the
+    best epochs, and return the best R@1 so far and whether this epoch is the (provisional) best model."""
+    ci_low, ci_high = test.get_recall_confidence_interval(recalls[0], epochs_val_ds.queries_num)
+    logging.info(f"Epoch {epoch_num:02d}, {epochs_val_ds}: {recalls_str[:20]} (R@1 95% CI: {ci_low:.1f} - {ci_high:.1f})")
+    val_candidates.append((recalls[0], epoch_num, state_dict))
+    val_candidates.sort(key=lambda candidate: -candidate[0])
+    del val_candidates[args.val_candidates_num:]
+    # With val_queries_fraction < 1 the best model is provisional, and it is replaced at the end of training
+    return max(recalls[0], best_val_recall1), recalls[0] > best_val_recall1
+# The test set is only used at the end of training, so it is created (and indexed) only then
 
 #### Resume
 if args.resume_train:        # se è passato il path del checkpoint di cui fare il resume. E' come se salvasse un certo punto del train specifico (checkpoint)  
-    model, model_optimizer, classifiers, classifiers_optimizers, best_val_recall1, start_epoch_num = \
+    model, model_optimizer, classifiers, classifiers_optimizers, best_val_recall1, start_epoch_num, validation_pending = \
         util.resume_train(args, output_folder, model, model_optimizer, classifiers, classifiers_optimizers)           # carica il checkpoint
     model = model.to(args.device)
     epoch_num = start_epoch_num - 1
     logging.info(f"Resuming from epoch {start_epoch_num} with best R@1 {best_val_recall1:.1f} from checkpoint {args.resume_train}")
 else:                           # se non c'è resume, riparte da zero
     best_val_recall1 = start_epoch_num = 0
+    validation_pending = False
+# With validation on a subset, the best model before resuming is also validated on the whole val_ds at the end
+# of training, since best_model.pth might be overwritten by a provisional best model in the meantime
+resumed_best_state_dict = None
+if args.resume_train and args.val_queries_fraction < 1 and os.path.exists(f"{output_folder}/best_model.pth"):
+    resumed_best_state_dict = torch.load(f"{output_folder}/best_model.pth", map_location="cpu")
 
 #### Train / evaluation loop
 logging.info("Start training ...")
@@ -123,25 +161,53 @@ if args.augmentation_device == "cuda":           # data augmentation. Da cpu a g
 if args.use_amp16:
     scaler = torch.cuda.amp.GradScaler()
 
+# The workers are started only once, and they load the batches of one group at a time
+if args.shared_memory_loader:
+    # Workers write uint8 images in shared memory, which are converted to float on device
+    dataloader = commons.SharedMemoryBatchLoader(groups, batch_size=args.batch_size, num_workers=args.num_workers,
+                                                 device=args.device, group_num=start_epoch_num % args.groups_num)
+else:
+    dataloader = commons.GroupsDataLoader(groups, batch_size=args.batch_size, num_workers=args.num_workers,   # il dataloader permetteva di iterare sul dataset, batch size = 32
+                                          pin_memory=(args.device == "cuda"), group_num=start_epoch_num % args.groups_num)
+
+# Idle classifiers are kept in (pinned) host memory, and copied to and from the device while training
+classifiers_swapper = util.ClassifiersSwapper(classifiers, classifiers_optimizers, args.device,
+                                              compact=args.compact_idle_classifiers)
+checkpoint_writer = util.CheckpointWriter(output_folder)
+if args.background_validation:
+    background_validator = test.BackgroundValidator(val_args, epochs_val_ds, model)
+if validation_pending:
+    # The last epoch before resuming was still being validated in background when it was checkpointed
+    pending_val_ds = epochs_val_ds if fast_validation else val_ds
+    recalls, recalls_str = test.test(val_args, pending_val_ds, model)
+    state_dict = {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()}
+    if fast_validation:
+        best_val_recall1, is_best = add_val_candidate(start_epoch_num - 1, recalls, recalls_str, state_dict, best_val_recall1)
+    else:
+        logging.info(f"Epoch {start_epoch_num - 1:02d}, {val_ds}: {recalls_str[:20]}")
+        is_best, best_val_recall1 = recalls[0] > best_val_recall1, max(recalls[0], best_val_recall1)
+    if is_best:
+        checkpoint_writer.save_best_model(state_dict)
+# The classifier of the next group starts being copied to the device during the last iterations of each epoch
+prefetch_iteration = int(args.iterations_per_epoch * 0.95)
+
 for epoch_num in range(start_epoch_num, args.epochs_num):        # inizia il training
     
     #### Train
     epoch_start_time = datetime.now()                             # prende tempo e data di oggi
     # Select classifier and dataloader according to epoch            nell'idea di avere a che fare con più gruppi e più classifier
     current_group_num = epoch_num % args.groups_num               # avendo un solo gruppo, il resto è sempre zero. Se avessi due gruppi, nelle
-    classifiers[current_group_num] = classifiers[current_group_num].to(args.device)       # sposta il classfier del gruppo nel device
-    util.move_to_device(classifiers_optimizers[current_group_num], args.device)           # sposta l'optimizer del gruppo nel device
+    classifiers_swapper.get(current_group_num)                    # il classifier del gruppo (e il suo optimizer) è già stato copiato sul device durante l'epoca precedente
     
-    dataloader = commons.InfiniteDataLoader(groups[current_group_num], num_workers=args.num_workers,     # il dataloader permetteva di iterare sul dataset, batch size = 32
-                                            batch_size=args.batch_size, shuffle=True,
-                                            pin_memory=(args.device == "cuda"), drop_last=True)
-    
-    dataloader_iterator = iter(dataloader)         # prende l'iteratore del dataloader
+    dataloader.set_group(current_group_num)        # i batch del gruppo sono già stati caricati durante la validation precedente
     model = model.train()                          # mette il modello in modalità training (non l'aveva già fatto?)
     
-    epoch_losses = np.zeros((0, 1), dtype=np.float32)                      # 0 righe, 1 colonna -> l'array è vuoto
-    for iteration in tqdm(range(args.iterations_per_epoch), ncols=100):    # ncols è la grandezza della barra, 10k iterazioni per gruppo
-        images, targets, _ = next(dataloader_iterator)                     # ritorna il batch di immagini e le rispettive classi
+    epoch_losses = commons.DeviceAccumulator(args.device, history_len=args.iterations_per_epoch if args.loss_history else 0)   # somma delle loss sul device, senza sincronizzarsi ad ogni iterazione
+    progress_bar = tqdm(range(args.iterations_per_epoch), ncols=100)
+    for iteration in progress_bar:                                         # ncols è la grandezza della barra, 10k iterazioni per gruppo
+        if iteration == prefetch_iteration and epoch_num + 1 < args.epochs_num:
+            classifiers_swapper.prefetch((epoch_num + 1) % args.groups_num)
+        images, targets, _ = next(dataloader)                              # ritorna il batch di immagini e le rispettive classi
         images, targets = images.to(args.device), targets.to(args.device)  # mette tutto su device
 
         if args.augmentation_device == "cuda":
@@ -154,60 +220,123 @@ for epoch_num in range(start_epoch_num, args.epochs_num):        # inizia il tra
         
         if not args.use_amp16:
             descriptors = model(images)                                     # inserisce il batch di immagini e restituisce il descrittore
-            output = classifiers[current_group_num](descriptors, targets)   # riporta l'output del classifier (applica quindi la loss ai batches). Però passa sia descrittore cha label
-            loss = criterion(output, targets)                               # calcola la loss (in funzione di output e target)
+            loss = classifiers[current_group_num](descriptors, targets)     # il classifier calcola logits, margine e cross-entropy in un solo passaggio
             loss.backward()                                                 # calcola il gradiente per ogni parametro che ha il grad settato a True
-            epoch_losses = np.append(epoch_losses, loss.item())             # in epoch losses ci appende questa loss
-            del loss, output, images                                        # elimina questi oggetti. Con la keyword del, l'intento è più chiaro
+            epoch_losses.add(loss)                                          # in epoch losses ci aggiunge questa loss
+            del loss, images                                                # elimina questi oggetti. Con la keyword del, l'intento è più chiaro
             model_optimizer.step()                                          # update dei parametri insieriti nell'ottimizzatore del modello
             classifiers_optimizers[current_group_num].step()                # update anche dei parametri del layer classificatore 
         else:  # Use AMP 16
             with torch.cuda.amp.autocast():                                 # funzionamento che sfrutta amp16 per uno speed-up. Non trattato
                 descriptors = model(images)                                 # comunque di base sono gli stessi passaggi ma con qualche differenza  
-                output = classifiers[current_group_num](descriptors, targets)
-                loss = criterion(output, targets)
+                loss = classifiers[current_group_num](descriptors, targets)
             scaler.scale(loss).backward()
-            epoch_losses = np.append(epoch_losses, loss.item())
-            del loss, output, images
+            epoch_losses.add(loss)
+            del loss, images
             scaler.step(model_optimizer)
             scaler.step(classifiers_optimizers[current_group_num])
             scaler.update()
+        
+        if (iteration + 1) % args.loss_sync_iterations == 0:
+            progress_bar.set_postfix(loss=f"{epoch_losses.mean():.4f}")    # solo qui si aspetta la GPU per leggere la loss
     
-    classifiers[current_group_num] = classifiers[current_group_num].cpu()   # passsa il classifier alla cpu termina l'epoca       
-    util.move_to_device(classifiers_optimizers[current_group_num], "cpu")   # passa anche l'optimizer alla cpu
+    if epoch_num + 1 < args.epochs_num:
+        # Workers start loading batches of the next group while this one is being validated
+        dataloader.set_group((epoch_num + 1) % args.groups_num)
+    
+    if (epoch_num + 1) % args.groups_num != current_group_num:
+        classifiers_swapper.release(current_group_num)                      # il classifier torna in memoria host, in modo asincrono
     
     logging.debug(f"Epoch {epoch_num:02d} in {str(datetime.now() - epoch_start_time)[:-7]}, "
                 f"loss = {epoch_losses.mean():.4f}")                  # stampa la loss
 
-    ## Se si vuole fare un grafico, si può usare "epoch_losses"
+    ## Se si vuole fare un grafico, si può usare "epoch_losses.get_history()" (con --loss_history)
 
     #### Evaluation
-    recalls, recalls_str = test.test(args, val_ds, model)              # passa validation dataset e modello (allenato) per il calcolo delle recall
-    logging.info(f"Epoch {epoch_num:02d} in {str(datetime.now() - epoch_start_time)[:-7]}, {val_ds}: {recalls_str[:20]}")
-    is_best = recalls[0] > best_val_recall1                            # lo confronta con il valore della recall maggiore. E' un valore booleano
-    best_val_recall1 = max(recalls[0], best_val_recall1)               # prende il valore massimo tra le due  
+    provisional_best_state_dict = None
+    if not fast_validation:
+        recalls, recalls_str = test.test(val_args, val_ds, model)              # passa validation dataset e modello (allenato) per il calcolo delle recall
+        logging.info(f"Epoch {epoch_num:02d} in {str(datetime.now() - epoch_start_time)[:-7]}, {val_ds}: {recalls_str[:20]}")
+        is_best = recalls[0] > best_val_recall1                            # lo confronta con il valore della recall maggiore. E' un valore booleano
+        best_val_recall1 = max(recalls[0], best_val_recall1)               # prende il valore massimo tra le due  
+    else:
+        if args.background_validation:
+            validation_result = background_validator.wait()                # risultato della validation dell'epoca precedente
+            background_validator.start(epoch_num, model)                   # valida questa epoca mentre parte la prossima
+        else:
+            recalls, recalls_str = test.test(val_args, epochs_val_ds, model)
+            validation_result = (epoch_num, recalls, recalls_str, {k: v.detach().to("cpu", copy=True) for k, v in model.state_dict().items()})
+        if validation_result is not None:
+            best_val_recall1, is_provisional_best = add_val_candidate(*validation_result, best_val_recall1)
+        is_best = validation_result is not None and is_provisional_best and validation_result[0] == epoch_num
+        if validation_result is not None and is_provisional_best and not is_best:
+            provisional_best_state_dict = validation_result[3]             # epoca precedente (validata in background), scritta insieme al checkpoint
     # Save checkpoint, which contains all training parameters
-    util.save_checkpoint({
+    # I classifier inattivi possono essere in forma compatta, e quelli copiati in modo asincrono devono essere arrivati in memoria host
+    classifiers_state_dicts, optimizers_state_dicts = classifiers_swapper.get_state_dicts()
+    # Il checkpoint viene copiato in memoria host e scritto in background; solo il classifier del gruppo corrente viene riscritto
+    checkpoint_writer.save({
         "epoch_num": epoch_num + 1,
         "model_state_dict": model.state_dict(),
         "optimizer_state_dict": model_optimizer.state_dict(),
-        "classifiers_state_dict": [c.state_dict() for c in classifiers],
-        "optimizers_state_dict": [c.state_dict() for c in classifiers_optimizers],
-        "best_val_recall1": best_val_recall1
-    }, is_best, output_folder)
+        "best_val_recall1": best_val_recall1,
+        # L'epoca corrente, validata in background, viene validata di nuovo in caso di resume
+        "validation_pending": fast_validation and args.background_validation
+    }, is_best, classifiers_state_dicts, optimizers_state_dicts, changed_groups=[current_group_num],
+       best_model_state_dict=provisional_best_state_dict)
 
-# Fa un checkpoint ad ogni epoca salvando il dizionario di su (chiamato state in save_checkpoint) ed inoltre salva anche il modello
+# Fa un checkpoint ad ogni epoca salvando il dizionario di su (con CheckpointWriter) ed inoltre salva anche il modello
 # finora migliore come "best_model". Questo significa che non è detto che il migliore sia nella ultima epoca. Anche perché ad ogni epoca 
 # il gruppo cambia
 
+dataloader.close()
+checkpoint_writer.wait()
 logging.info(f"Trained for {epoch_num+1:02d} epochs, in total in {str(datetime.now() - start_time)[:-7]}")
 
+best_model_state_dict = None
+if fast_validation and args.background_validation:
+    validation_result = background_validator.wait()
+    if validation_result is not None:
+        best_val_recall1, is_provisional_best = add_val_candidate(*validation_result, best_val_recall1)
+        if is_provisional_best:
+            checkpoint_writer.save_best_model(validation_result[3])
+if args.val_queries_fraction < 1:
+    # The best epochs on the subset are validated on the whole validation set, to select best_model.pth.
+    # Epochs validated on the whole validation set (i.e. only in background) already selected it
+    logging.info(f"Selecting the best model among epochs {[c[1] for c in val_candidates]}"
+                 f"{' and the best model before resuming' if resumed_best_state_dict is not None else ''} on {val_ds}")
+    final_candidates = [(f"Epoch {candidate_epoch_num:02d}", state_dict) for _, candidate_epoch_num, state_dict in val_candidates]
+    if resumed_best_state_dict is not None:
+        final_candidates.insert(0, ("Best model before resuming", resumed_best_state_dict))
+    best_full_val_recall1 = -1
+    for candidate_name, state_dict in final_candidates:
+        model.load_state_dict(state_dict)
+        recalls, recalls_str = test.test(val_args, val_ds, model)
+        logging.info(f"{candidate_name}, {val_ds}: {recalls_str[:20]}")
+        if recalls[0] > best_full_val_recall1:
+            best_full_val_recall1, best_model_state_dict = recalls[0], state_dict
+    if best_model_state_dict is not None:
+        checkpoint_writer.save_best_model(best_model_state_dict)
+
 #### Test best model on test set v1
-best_model_state_dict = torch.load(f"{output_folder}/best_model.pth")    # carica il best model (salvato da save_checkpoint se is_best è True)
+if best_model_state_dict is None:
+    checkpoint_writer.wait()                                              # best_model.pth potrebbe essere ancora in scrittura
+    best_model_state_dict = torch.load(f"{output_folder}/best_model.pth")    # carica il best model (salvato da CheckpointWriter se is_best è True)
 model.load_state_dict(best_model_state_dict)
 
+test_ds = TestDataset(args.test_set_folder, queries_folder="queries",positive_dist_threshold=args.positive_dist_threshold)
+logging.info(f"Test set: {test_ds}")
 logging.info(f"Now testing on the test set: {test_ds}")
 recalls, recalls_str = test.test(args, test_ds, model)                   # prova il modello migliore sul dataset di test (queries v1)
 logging.info(f"{test_ds}: {recalls_str}")
 
+if args.pca_dim is not None:
+    # The PCA-whitening is fit on the database of the validation set, so that the test set is never seen
+    whitening = PCAWhitening.fit(test.get_database_descriptors(args, val_ds, model), args.pca_dim)
+    whitening.save(f"{output_folder}/pca_whitening.npz")
+    logging.info(f"Saved PCA-whitening to {args.pca_dim} dimensions in {output_folder}/pca_whitening.npz")
+    recalls, recalls_str = test.test(args, test_ds, model, whitening)
+    logging.info(f"{test_ds} with PCA-whitening: {recalls_str}")
+
+checkpoint_writer.wait()
 logging.info("Experiment finished (without any errors)")
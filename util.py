@@ -1,11 +1,13 @@
 
+import os
 import faiss
 import torch
 import shutil
+import threading
 import logging
 from typing import Type, List
 from argparse import Namespace
-from cosface_loss import MarginCosineProduct
+from margin_head import MarginHead
 import numpy as np
 from torch.utils.data import DataLoader
 from tqdm import tqdm
@@ -13,26 +15,311 @@ from tqdm import tqdm
 def move_to_device(optimizer: Type[torch.optim.Optimizer], device: str):
     for state in optimizer.state.values():
         for k, v in state.items():
-            if torch.is_tensor(v):
+            if torch.is_tensor(v) and v.dim() > 0:  # Adam's step stays on the host, see get_tensors_accessors()
                 state[k] = v.to(device)
 
 
-def save_checkpoint(state: dict, is_best: bool, output_folder: str,
-                    ckpt_filename: str = "last_checkpoint.pth"):
-    # TODO it would be better to move weights to cpu before saving
-    checkpoint_path = f"{output_folder}/{ckpt_filename}"
-    torch.save(state, checkpoint_path)
-    if is_best:
-        torch.save(state["model_state_dict"], f"{output_folder}/best_model.pth")
+class ClassifiersSwapper:
+    def __init__(self, classifiers: list, classifiers_optimizers: list, device: str, compact: bool = False):
+        """Move the classifier (and optimizer state) of one group at a time to the device.
+        On CUDA, idle classifiers are kept in pinned host memory, and they are copied to and from
+        the device on a side stream, so that the copies overlap with the training:
+            prefetch(group_num) starts copying a classifier to the device (e.g. during the last iterations of an epoch),
+            get(group_num) makes the current stream wait for it, and returns the classifier and its optimizer,
+            release(group_num) starts copying it back to host memory.
+        If compact is True, idle classifiers are stored with compact_state_dict(), i.e. less than half
+        of their memory, and they are expanded again when their group comes up.
+        Call synchronize() before reading idle classifiers on the host (e.g. to save a checkpoint).
+        """
+        self.classifiers = classifiers
+        self.optimizers = classifiers_optimizers
+        self.device = device
+        self.compact = compact
+        self.compact_states = {}  # group_num -> (classifier state_dict, optimizer state_dict) in compact form
+        self.on_device = set()
+        self.events = {}
+        self.stream = torch.cuda.Stream() if device == "cuda" else None
+        for group_num in range(len(classifiers)):
+            if compact:
+                self.compact_states[group_num] = self.to_compact_state(group_num, "cpu")
+            elif self.stream is not None:
+                for get_tensor, set_tensor in self.get_tensors_accessors(group_num):
+                    set_tensor(get_tensor().cpu().pin_memory())
+    
+    def get_tensors_accessors(self, group_num):
+        """Return a (getter, setter) pair for each tensor of the classifier and its optimizer state.
+        Scalar tensors (i.e. Adam's step) stay on the host, since Adam reads them with .item() at each step."""
+        accessors = []
+        for param in self.classifiers[group_num].parameters():
+            accessors.append((lambda p=param: p.data, lambda t, p=param: setattr(p, "data", t)))
+        for state in self.optimizers[group_num].state.values():
+            for k, v in state.items():
+                if torch.is_tensor(v) and v.dim() > 0:
+                    accessors.append((lambda st=state, k=k: st[k], lambda t, st=state, k=k: st.__setitem__(k, t)))
+        return accessors
+    
+    def to_compact_state(self, group_num, device):
+        """Return the compact state of a classifier and its optimizer on device, and free their tensors."""
+        compact_state = (compact_state_dict(self.classifiers[group_num].state_dict()),
+                         compact_state_dict(self.optimizers[group_num].state_dict()))
+        compact_state = map_tensors(compact_state, lambda t: to_device(t, device))
+        for get_tensor, _ in self.get_tensors_accessors(group_num):
+            if self.stream is not None and get_tensor().is_cuda:
+                get_tensor().record_stream(self.stream)  # freed only once the copy is done
+        for param in self.classifiers[group_num].parameters():
+            param.data = torch.empty(0, dtype=param.dtype, device=param.device)
+        self.optimizers[group_num].state.clear()
+        return compact_state
+    
+    def from_compact_state(self, group_num):
+        classifier_state_dict, optimizer_state_dict = expand_state_dict(
+            map_tensors(self.compact_states.pop(group_num), lambda t: to_device(t, self.device)))
+        for name, param in self.classifiers[group_num].named_parameters():
+            param.data = classifier_state_dict[name]
+        self.optimizers[group_num].load_state_dict(optimizer_state_dict)  # state is moved to the device of the params
+    
+    def prefetch(self, group_num):
+        if group_num in self.on_device:
+            return
+        self.on_device.add(group_num)
+        if self.stream is None:
+            if self.compact:
+                self.from_compact_state(group_num)
+            self.classifiers[group_num].to(self.device)
+            move_to_device(self.optimizers[group_num], self.device)
+            return
+        # Host tensors might still be written by a previous release()
+        if group_num in self.events:
+            self.stream.wait_event(self.events[group_num])
+        current_stream = torch.cuda.current_stream()
+        with torch.cuda.stream(self.stream):
+            if self.compact:
+                self.from_compact_state(group_num)
+                for get_tensor, _ in self.get_tensors_accessors(group_num):
+                    get_tensor().record_stream(current_stream)  # used later by the training stream
+            else:
+                for get_tensor, set_tensor in self.get_tensors_accessors(group_num):
+                    device_tensor = get_tensor().to(self.device, non_blocking=True)
+                    device_tensor.record_stream(current_stream)  # used later by the training stream
+                    set_tensor(device_tensor)
+            self.events[group_num] = torch.cuda.Event()
+            self.events[group_num].record(self.stream)
+    
+    def get(self, group_num):
+        self.prefetch(group_num)
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_event(self.events[group_num])
+        return self.classifiers[group_num], self.optimizers[group_num]
+    
+    def release(self, group_num):
+        if group_num not in self.on_device:
+            return
+        self.on_device.remove(group_num)
+        for param in self.classifiers[group_num].parameters():
+            param.grad = None  # Gradients are recomputed at the next step
+        if self.stream is None:
+            if self.compact:
+                self.compact_states[group_num] = self.to_compact_state(group_num, "cpu")
+            else:
+                self.classifiers[group_num].cpu()
+                move_to_device(self.optimizers[group_num], "cpu")
+            return
+        # The copy starts once the training steps queued on the default stream are done
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            if self.compact:
+                # Compacted on the device, so that less data is copied
+                self.compact_states[group_num] = self.to_compact_state(group_num, "pinned")
+            else:
+                for get_tensor, set_tensor in self.get_tensors_accessors(group_num):
+                    device_tensor = get_tensor()
+                    device_tensor.record_stream(self.stream)  # freed only once the copy is done
+                    set_tensor(to_device(device_tensor, "pinned"))
+            self.events[group_num] = torch.cuda.Event()
+            self.events[group_num].record(self.stream)
+    
+    def synchronize(self):
+        if self.stream is not None:
+            self.stream.synchronize()
+    
+    def get_state_dicts(self):
+        """Return the state_dicts of all classifiers and of all their optimizers, where those of
+        idle classifiers are in compact form if compact is True (see expand_state_dict())."""
+        self.synchronize()
+        classifiers_state_dicts, optimizers_state_dicts = [], []
+        for group_num in range(len(self.classifiers)):
+            if group_num in self.compact_states:
+                classifier_state_dict, optimizer_state_dict = self.compact_states[group_num]
+            else:
+                classifier_state_dict = self.classifiers[group_num].state_dict()
+                optimizer_state_dict = self.optimizers[group_num].state_dict()
+            classifiers_state_dicts.append(classifier_state_dict)
+            optimizers_state_dicts.append(optimizer_state_dict)
+        return classifiers_state_dicts, optimizers_state_dicts
+
+
+def to_device(tensor: torch.Tensor, device: str) -> torch.Tensor:
+    """Same as tensor.to(device, non_blocking=True), where device "pinned" is pinned host memory."""
+    if device == "pinned":
+        host_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+        return host_tensor.copy_(tensor, non_blocking=True)
+    return tensor.to(device, non_blocking=True)
+
+
+def map_tensors(obj, function):
+    """Apply function to all tensors within nested dicts, lists and tuples."""
+    if torch.is_tensor(obj):
+        return function(obj)
+    if isinstance(obj, dict):
+        return {k: map_tensors(v, function) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(map_tensors(v, function) for v in obj)
+    return obj
+
+
+def compact_state_dict(obj, key=None):
+    """Return a compact copy of a (classifier or optimizer) state_dict: Adam moments are quantized
+    to int8 with a scale per row (the second moment through its square root, rounded up, so that
+    it's never underestimated), and other float matrices (i.e. weights) are stored as bfloat16.
+    """
+    if isinstance(obj, dict):
+        return {k: compact_state_dict(v, k) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [compact_state_dict(v) for v in obj]
+    if not torch.is_tensor(obj) or not obj.is_floating_point() or obj.dim() != 2:
+        return obj
+    if key in ["exp_avg", "exp_avg_sq"]:
+        is_squared = key == "exp_avg_sq"
+        values = obj.float().sqrt() if is_squared else obj.float()
+        scale = values.abs().amax(dim=1, keepdim=True).clamp(min=1e-30) / 127
+        rounding = torch.ceil if is_squared else torch.round
+        quantized = rounding(values / scale).clamp(-127, 127).to(torch.int8)
+        return {"compact": "int8", "quantized": quantized, "scale": scale, "squared": is_squared}
+    return {"compact": "bfloat16", "tensor": obj.to(torch.bfloat16)}
+
+
+def expand_state_dict(obj):
+    """Inverse of compact_state_dict() (state_dicts which are not compact are returned as they are)."""
+    if isinstance(obj, dict):
+        if obj.get("compact") == "bfloat16":
+            return obj["tensor"].float()
+        if obj.get("compact") == "int8":
+            values = obj["quantized"].float() * obj["scale"]
+            return values.square() if obj["squared"] else values
+        return {k: expand_state_dict(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(expand_state_dict(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter:
+    def __init__(self, output_folder: str):
+        """Save checkpoints in a background thread, with weights copied to host memory first, in this layout:
+            last_checkpoint.pth : epoch_num, optimizer_state_dict, best_val_recall1, and the names of the
+                files with the model and with the classifier (and optimizer) of each group.
+            model_epochXXX.pth : the model_state_dict, best_model.pth is a hard link to it when is_best.
+            best_model.pth : otherwise written from best_model_state_dict, if given (e.g. a previous epoch).
+            classifier_groupXX_epochXXX.pth : (classifier state_dict, optimizer state_dict) of a group.
+        Only the classifiers of the groups which changed are written again, the others are referenced
+        from the files of previous epochs. Files are written with atomic renames, so that a run
+        interrupted while saving always leaves a consistent checkpoint.
+        """
+        self.output_folder = output_folder
+        self.classifiers_files = {}  # group_num -> filename of its latest classifier
+        self.thread = None
+        self.error = None
+    
+    def save(self, state: dict, is_best: bool, classifiers_state_dicts: list, optimizers_state_dicts: list,
+             changed_groups: list, best_model_state_dict: dict = None):
+        """Snapshot state (epoch_num, model_state_dict, optimizer_state_dict, best_val_recall1, ...) and the
+        classifiers of changed_groups (and of groups never saved) in host memory, and write them in background."""
+        self.wait()  # At most one checkpoint is being written, to bound host memory
+        groups_to_write = [g for g in range(len(classifiers_state_dicts))
+                           if g in changed_groups or g not in self.classifiers_files]
+        snapshot = map_tensors({
+            "state": state,
+            "groups": {g: (classifiers_state_dicts[g], optimizers_state_dicts[g]) for g in groups_to_write},
+            "best_model_state_dict": best_model_state_dict,
+        }, lambda t: t.detach().to("cpu", copy=True))
+        self.thread = threading.Thread(target=self.write, args=(snapshot, is_best), daemon=True)
+        self.thread.start()
+    
+    def save_best_model(self, best_model_state_dict: dict):
+        """Write best_model.pth in background (outside of save(), e.g. after training)."""
+        self.wait()
+        snapshot = map_tensors(best_model_state_dict, lambda t: t.detach().to("cpu", copy=True))
+        self.thread = threading.Thread(target=self.write_best_model, args=(snapshot,), daemon=True)
+        self.thread.start()
+    
+    def write_best_model(self, best_model_state_dict: dict):
+        try:
+            atomic_save(best_model_state_dict, f"{self.output_folder}/best_model.pth")
+        except Exception as e:
+            self.error = e
+    
+    def write(self, snapshot: dict, is_best: bool):
+        try:
+            state = snapshot["state"]
+            epoch_num = state["epoch_num"]
+            old_files = set(self.classifiers_files.values())
+            for group_num, group_state in snapshot["groups"].items():
+                filename = f"classifier_group{group_num:02d}_epoch{epoch_num:03d}.pth"
+                atomic_save(group_state, f"{self.output_folder}/{filename}")
+                self.classifiers_files[group_num] = filename
+            model_filename = f"model_epoch{epoch_num:03d}.pth"
+            atomic_save(state["model_state_dict"], f"{self.output_folder}/{model_filename}")
+            if is_best:
+                # best_model.pth shares the data of the model file, instead of writing it a second time
+                tmp_path = f"{self.output_folder}/best_model.pth.tmp"
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                try:
+                    os.link(f"{self.output_folder}/{model_filename}", tmp_path)
+                except OSError:  # The filesystem doesn't support hard links
+                    shutil.copyfile(f"{self.output_folder}/{model_filename}", tmp_path)
+                os.replace(tmp_path, f"{self.output_folder}/best_model.pth")
+            elif snapshot["best_model_state_dict"] is not None:
+                atomic_save(snapshot["best_model_state_dict"], f"{self.output_folder}/best_model.pth")
+            checkpoint = {k: v for k, v in state.items() if k != "model_state_dict"}
+            checkpoint["model_file"] = model_filename
+            checkpoint["classifiers_files"] = [self.classifiers_files[g] for g in sorted(self.classifiers_files)]
+            atomic_save(checkpoint, f"{self.output_folder}/last_checkpoint.pth")
+            # Files which are not referenced anymore can be removed
+            old_files |= {f for f in os.listdir(self.output_folder) if f.startswith("model_epoch")}
+            for filename in old_files - set(self.classifiers_files.values()) - {model_filename}:
+                os.remove(f"{self.output_folder}/{filename}")
+        except Exception as e:
+            self.error = e
+    
+    def wait(self):
+        """Wait for the checkpoint being written, and raise any error which occurred while writing it."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Saving the checkpoint failed") from error
+
+
+def atomic_save(obj, path: str):
+    torch.save(obj, f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
 
 
 def resume_train(args: Namespace, output_folder: str, model: torch.nn.Module,
-                 model_optimizer: Type[torch.optim.Optimizer], classifiers: List[MarginCosineProduct],
+                 model_optimizer: Type[torch.optim.Optimizer], classifiers: List[MarginHead],
                  classifiers_optimizers: List[Type[torch.optim.Optimizer]]):
     """Load model, optimizer, and other training parameters"""
     logging.info(f"Loading checkpoint: {args.resume_train}")
     checkpoint = torch.load(args.resume_train)
     start_epoch_num = checkpoint["epoch_num"]
+    checkpoint_folder = os.path.dirname(args.resume_train)
+    if "model_file" in checkpoint:
+        # Saved by CheckpointWriter, with model and classifiers within separate files
+        checkpoint["model_state_dict"] = torch.load(os.path.join(checkpoint_folder, checkpoint["model_file"]))
+        groups_states = [torch.load(os.path.join(checkpoint_folder, f)) for f in checkpoint["classifiers_files"]]
+        checkpoint["classifiers_state_dict"] = [classifier_state_dict for classifier_state_dict, _ in groups_states]
+        checkpoint["optimizers_state_dict"] = [optimizer_state_dict for _, optimizer_state_dict in groups_states]
     
     model_state_dict = checkpoint["model_state_dict"]
     model.load_state_dict(model_state_dict)
@@ -48,16 +335,22 @@ def resume_train(args: Namespace, output_folder: str, model: torch.nn.Module,
     for c, sd in zip(classifiers, checkpoint["classifiers_state_dict"]):
         # Move classifiers to GPU before loading their optimizers
         c = c.to(args.device)
-        c.load_state_dict(sd)
+        c.load_state_dict(expand_state_dict(sd))  # Idle classifiers might have been saved in compact form
     for c, sd in zip(classifiers_optimizers, checkpoint["optimizers_state_dict"]):
-        c.load_state_dict(sd)
+        c.load_state_dict(expand_state_dict(sd))
     for c in classifiers:
         # Move classifiers back to CPU to save some GPU memory
         c = c.cpu()
     
     best_val_recall1 = checkpoint["best_val_recall1"]
+    # With background validation, the last epoch was still being validated when the checkpoint was saved
+    validation_pending = checkpoint.get("validation_pending", False)
     
-    # Copy best model to current output_folder
-    shutil.copy(args.resume_train.replace("last_checkpoint.pth", "best_model.pth"), output_folder)
+    # Copy best model to current output_folder. It might not exist yet, if no epoch had been validated
+    best_model_path = args.resume_train.replace("last_checkpoint.pth", "best_model.pth")
+    if os.path.exists(best_model_path):
+        shutil.copy(best_model_path, output_folder)
+    else:
+        logging.info(f"There is no {best_model_path} to copy, no epoch had been validated before resuming")
     
-    return model, model_optimizer, classifiers, classifiers_optimizers, best_val_recall1, start_epoch_num
\ No newline at end of file
+    return model, model_optimizer, classifiers, classifiers_optimizers, best_val_recall1, start_epoch_num, validation_pending
\ No newline at end of file